@@ -12,7 +12,11 @@ from .wps_ensemble_indices_point import XclimEnsembleGridPointBase
 from .wps_ensemble_indices_polygon import XclimEnsemblePolygonBase
 from .wps_geoseries_to_netcdf import GeoseriesToNetcdfProcess
 from .wps_hourly_to_daily import HourlyToDailyProcess
-from .wps_sdba import EmpiricalQuantileMappingProcess
+from .wps_sdba import (
+    DetrendedQuantileMappingProcess,
+    EmpiricalQuantileMappingProcess,
+    QuantileDeltaMappingProcess,
+)
 from .wps_xaverage_polygon import AveragePolygonProcess
 from .wps_xclim_indices import XclimIndicatorBase
 from .wps_xsubset_bbox import SubsetBboxProcess
@@ -105,7 +109,11 @@ def get_processes():
         )
 
     # Statistical downscaling and bias adjustment
-    processes += [EmpiricalQuantileMappingProcess()]
+    processes += [
+        EmpiricalQuantileMappingProcess(),
+        DetrendedQuantileMappingProcess(),
+        QuantileDeltaMappingProcess(),
+    ]
 
     # ensemble with grid point subset
     for ind in ensemble_indicators:
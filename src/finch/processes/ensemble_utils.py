@@ -1,19 +1,23 @@
 # noqa: D100
 import logging
+import os
+import re
+import shutil
 import sys
 import warnings
-from collections import deque
 from collections.abc import Iterable
-from copy import deepcopy
 from dataclasses import dataclass
 from datetime import datetime
+from graphlib import TopologicalSorter
+from hashlib import sha256
 from pathlib import Path
 
-import geopandas as gpd
+import dask
 import pandas as pd
 import xarray as xr
+import xclim
 from pandas.api.types import is_numeric_dtype
-from parse import parse
+from parse import Parser, parse
 from pywps import FORMATS, ComplexInput, Process
 from pywps.app.exceptions import ProcessError
 from pywps.exceptions import InvalidParameterValue
@@ -25,27 +29,37 @@ from xclim.indicators.atmos import tg
 from xscen.aggregate import climatological_op, compute_deltas, spatial_mean
 
 from . import wpsio
+from .polygons import prepare_shape, region_shape, spatial_average
 from .subset import finch_subset_bbox, finch_subset_gridpoint, finch_subset_shape
 from .utils import (
     DatasetConfiguration,
+    IndicatorArguments,
     PywpsInput,
     RequestInputs,
+    _max_chunk_elements,
+    chunk_dataset,
     compute_indices,
     dataset_to_dataframe,
     dataset_to_netcdf,
+    file_digest,
     format_metadata,
+    get_cache_dir,
     get_datasets_config,
     iter_xc_variables,
     log_file_path,
+    opened_datasets,
+    prune_cache,
     single_input_or_none,
     valid_filename,
     write_log,
     zip_files,
 )
-from .wps_base import make_nc_input
 
 LOGGER = logging.getLogger("PYWPS")
 
+# Number of intermediate variables kept in the "intermediate" cache
+MAX_CACHED_VARIABLES = 1000
+
 
 def _percentile_doy(var: xr.DataArray, perc: int) -> xr.DataArray:
     return percentile_doy(var, per=perc).sel(percentiles=perc, drop=True)
@@ -79,8 +93,11 @@ class Dataset:  # noqa: D101
     date_end: str | None = None
 
     @classmethod
-    def from_filename(cls, filename, pattern):  # noqa: D102
-        match = parse(pattern, filename)
+    def from_filename(cls, filename, pattern: str | Parser):  # noqa: D102
+        if isinstance(pattern, Parser):
+            match = pattern.parse(filename)
+        else:
+            match = parse(pattern, filename)
         if not match:
             return None
         return cls(**match.named)
@@ -88,7 +105,7 @@ class Dataset:  # noqa: D101
 
 def file_is_required(
     filename: str,
-    pattern: str,
+    pattern: str | Parser,
     model_lists: dict[str, list[str]] | None = None,
     variables: list[str] | None = None,
     scenario: str | None = None,
@@ -105,7 +122,7 @@ def file_is_required(
     if scenario and scenario not in file.scenario:
         return False
 
-    if models is None or models[0].lower() == "all":
+    if not models or (isinstance(models[0], str) and models[0].lower() == "all"):
         return True
 
     if (
@@ -204,12 +221,14 @@ def get_datasets(
     else:
         iterator = iter_remote(TDSCatalog(dsconf.path), depth=dsconf.depth)
 
+    # Model lists are resolved once here instead of for each file.
+    models = dsconf.resolve_models(models)
+
     inputs = []
     for name, url in iterator:
         if file_is_required(
             name,
-            dsconf.pattern,
-            dsconf.model_lists,
+            dsconf.parser,
             variables=variables,
             scenario=scenario,
             models=models,
@@ -295,61 +314,87 @@ def uses_accepted_netcdf_variables(
 
 def make_indicator_inputs(
     indicator: Indicator, wps_inputs: RequestInputs, files_list: list[Path]
-) -> list[RequestInputs]:
-    """From a list of files, make a list of inputs used to call the given xclim indicator."""
+) -> list[IndicatorArguments]:
+    """From a list of files, make a list of arguments used to call the given xclim indicator."""
     required_netcdf_args = set(iter_xc_variables(indicator))
-
-    input_list = []
+    arguments = IndicatorArguments.from_inputs(wps_inputs)
 
     if len(required_netcdf_args) == 1:
         variable_name = list(required_netcdf_args)[0]
-        for path in files_list:
-            inputs = deepcopy(wps_inputs)
-            inputs[variable_name] = deque([make_nc_input(variable_name)])
-            inputs[variable_name][0].file = str(path)
-            input_list.append(inputs)
-    else:
-        for group in make_file_groups(files_list, required_netcdf_args):
-            inputs = deepcopy(wps_inputs)
-            for variable_name, path in group.items():
-                if variable_name not in required_netcdf_args:
-                    continue
-                inputs[variable_name] = deque([make_nc_input(variable_name)])
-                inputs[variable_name][0].file = str(path)
-            input_list.append(inputs)
+        return [arguments.with_files({variable_name: path}) for path in files_list]
 
-    return input_list
+    return [
+        arguments.with_files(
+            {name: path for name, path in group.items() if name in required_netcdf_args}
+        )
+        for group in make_file_groups(files_list, required_netcdf_args)
+    ]
 
 
 def make_file_groups(files_list: list[Path], variables: set) -> list[dict[str, Path]]:
     """Group files by filenames, changing only the netcdf variable name.
 
-    The list of variable names to search must be given.
+    The list of variable names to search must be given. Files are grouped in a single
+    pass, keyed by their filename with the variable name left out. Files without a
+    variable name and incomplete groups are reported in the logs.
     """
-    groups = []
-    filenames = {f.name: f for f in files_list}
+    # Variable names may contain underscores (ex: tasmin_per), match the longest first
+    variables_by_tokens = {tuple(v.lower().split("_")): v for v in variables}
+    lengths = sorted({len(t) for t in variables_by_tokens}, reverse=True)
+    groups: dict[tuple, dict[str, Path]] = {}
 
     for file in files_list:
-        if file.name not in filenames:
+        tokens = file.name.lower().split("_")
+        # The variable is the first run of tokens of the name that is one of the variables
+        match = next(
+            (
+                (i, n)
+                for i in range(len(tokens) - 1)
+                for n in lengths
+                if tuple(tokens[i : i + n]) in variables_by_tokens
+            ),
+            None,
+        )
+        if match is None:
+            LOGGER.warning(
+                "No variable of %s found in filename: %s", variables, file.name
+            )
             continue
-        group = {}
-        for variable in variables:
-            if (
-                file.name.startswith(f"{variable.lower()}_")
-                or f"_{variable.lower()}_" in file.name
-            ):
-                for other_var in variables.difference({variable}):
-                    other_filename = file.name.replace(variable, other_var, 1)
-                    if other_filename in filenames:
-                        group[other_var] = filenames[other_filename]
-                        del filenames[other_filename]
-
-                group[variable] = file
-                del filenames[file.name]
-                groups.append(group)
-                break
+        i, n = match
+        variable = variables_by_tokens[tuple(tokens[i : i + n])]
+        key = (*tokens[:i], None, *tokens[i + n :])
+        group = groups.setdefault(key, {})
+        if variable in group:
+            LOGGER.warning("Duplicate file for %s: %s", variable, file.name)
+            continue
+        group[variable] = file
+
+    for group in groups.values():
+        if len(group) < len(variables):
+            LOGGER.warning(
+                "Missing variables %s for files %s",
+                variables.difference(group),
+                [f.name for f in group.values()],
+            )
+
+    return list(groups.values())
+
 
-    return groups
+def open_ensemble(files: list[Path], max_bytes: int | str | None = None) -> xr.Dataset:
+    """Open indicator files lazily as an ensemble along the `realization` dimension.
+
+    Members are chunked in space so that a block holding all members fits in `max_bytes`
+    (defaults to dask's `array.chunk-size`). Ensemble statistics are then computed block
+    by block, and memory scales with the block size instead of the members times the grid.
+    """
+    max_bytes = dask.utils.parse_bytes(max_bytes or dask.config.get("array.chunk-size"))
+    with xr.open_dataset(files[0]) as ds:
+        chunks = chunk_dataset(
+            ds, max_bytes=max(max_bytes // len(files), 1), operation="time"
+        )
+    return ensembles.create_ensemble(
+        files, realizations=[file.stem for file in files], chunks=chunks
+    )
 
 
 def make_ensemble(  # noqa: D103
@@ -359,9 +404,7 @@ def make_ensemble(  # noqa: D103
     tmpavg: bool | None = False,
     region: dict | None = None,
 ) -> None:
-    ensemble = ensembles.create_ensemble(
-        files, realizations=[file.stem for file in files]
-    )
+    ensemble = open_ensemble(files)
     # make sure we have data starting in 1950
     ensemble = ensemble.sel(time=(ensemble.time.dt.year >= 1950))
 
@@ -411,20 +454,20 @@ def make_ensemble(  # noqa: D103
     if spatavg:
         # ensemble = ensemble.mean(dim=average_dims)
         if region is None:
-            method = "cos-lat"
+            ensemble = spatial_mean(
+                ds=ensemble,
+                method="cos-lat",
+                spatial_subset=False,
+                region=region,
+                kwargs={"skipna": True},
+            )
         else:
-            method = "xesmf"
-        ensemble = spatial_mean(
-            ds=ensemble,
-            method=method,
-            spatial_subset=False,
-            region=region,
-            kwargs={"skipna": True},
-        )
+            ensemble = spatial_average(ensemble, region_shape(region), skipna=True)
 
     if percentiles:
+        # Members are already chunked for the memory budget, only merge the realizations
         ensemble_percentiles = ensembles.ensemble_percentiles(
-            ensemble, values=percentiles
+            ensemble, values=percentiles, keep_chunk_size=False
         )
     else:
         ensemble_percentiles = ensemble
@@ -445,6 +488,104 @@ def make_ensemble(  # noqa: D103
     return ensemble_percentiles
 
 
+def _intermediate_cache_path(
+    variable: str, input_files: list[Path], args: list
+) -> Path | None:
+    """Return the path of an intermediate variable in the persistent cache.
+
+    The key is made of the content of the (subsetted) input files, so that it covers the
+    source files, the subset bounds and the dates, and of the computation parameters.
+    Returns None when caching is disabled.
+    """
+    cache = get_cache_dir("intermediate")
+    if cache is None:
+        return None
+    key = repr(
+        (
+            variable,
+            [file_digest(f) for f in input_files],
+            args,
+            xclim.__version__,
+        )
+    )
+    return cache / f"{sha256(key.encode()).hexdigest()[:32]}.nc"
+
+
+def _link_or_copy(source: Path, destination: Path) -> None:
+    destination.unlink(missing_ok=True)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def _store_in_cache(path: Path, cached: Path) -> None:
+    # Write under a temporary name, so concurrent requests never read partial files
+    tmp = cached.with_suffix(f".{os.getpid()}.tmp")
+    try:
+        shutil.copyfile(path, tmp)
+        tmp.replace(cached)
+    except OSError as e:
+        LOGGER.warning("Could not cache %s: %s", path.name, e)
+        tmp.unlink(missing_ok=True)
+        return
+    prune_cache(cached.parent, "*.nc", MAX_CACHED_VARIABLES)
+
+
+@dataclass(frozen=True)
+class ComputationPlan:
+    """Resolution of the variables needed by an indicator against the available variables.
+
+    `steps` lists the variables to compute from `variable_computations`, each after its
+    own inputs, so that intermediates (ex: tas for both tas_per and the indicator) are
+    computed once.
+    """
+
+    raw: frozenset[str]
+    steps: tuple[str, ...]
+    extra: frozenset[str]
+
+    def __str__(self) -> str:  # noqa: D105
+        steps = "; ".join(
+            f"{v} <- {', '.join(variable_computations[v]['inputs'])}"
+            for v in self.steps
+        )
+        return (
+            f"sources: {', '.join(sorted(self.raw))}; computations: {steps or 'none'}"
+        )
+
+
+def plan_computations(
+    needed: Iterable[str], available: Iterable[str]
+) -> ComputationPlan:
+    """Plan the computation of the `needed` variables from the `available` ones.
+
+    Available variables are always used as is. Variables that are neither available
+    nor computable are returned as `extra`.
+    """
+    available = set(available)
+    raw, extra = set(), set()
+    graph: dict[str, set[str]] = {}
+    to_visit = list(needed)
+    while to_visit:
+        variable = to_visit.pop()
+        if variable in available:
+            raw.add(variable)
+        elif variable in variable_computations:
+            if variable not in graph:
+                inputs = variable_computations[variable]["inputs"]
+                graph[variable] = {i for i in inputs if i not in available}
+                to_visit.extend(inputs)
+        else:
+            extra.add(variable)
+
+    # Inputs that are neither available nor computable are not graph nodes
+    for predecessors in graph.values():
+        predecessors.intersection_update(graph)
+    steps = tuple(TopologicalSorter(graph).static_order())
+    return ComputationPlan(frozenset(raw), steps, frozenset(extra))
+
+
 def compute_intermediate_variables(
     files_list: list[Path],
     variables: set,
@@ -452,79 +593,180 @@ def compute_intermediate_variables(
     workdir: Path,
     request_inputs,
 ) -> list[Path]:
-    """Compute netcdf datasets from a list of required variable names and existing files."""
+    """Compute netcdf datasets from a list of required variable names and existing files.
+
+    Each variable of the plan is computed for all file groups at once, so that
+    computations can be batched across members (see :py:func:`batched_percentile_doy`).
+    """
     output_files_list = []
     file_groups = make_file_groups(files_list, variables)
+    plans = {}
+    group_steps = []
     for group in file_groups:
         # add file paths that are required without any computation
         for variable, path in group.items():
             if variable in required_variable_names:
                 output_files_list.append(path)
 
-        first_variable = list(group)[0]
-        output_basename = group[first_variable].name.split("_", 1)[1]
-
-        # compute other required variables
-        variables_to_compute = set(required_variable_names) - set(group)
-
-        # add intermediate files to compute (ex: tas is needed for tn10)
-        for variable in list(variables_to_compute):
-            for input_name in variable_computations[variable]["inputs"]:
-                if input_name in variable_computations:
-                    variables_to_compute.add(input_name)
-
-        while variables_to_compute:
-            for variable in list(variables_to_compute):
-                input_names = variable_computations[variable]["inputs"]
-                arg_names = variable_computations[variable]["args"]
-                if all(i in group for i in input_names) and all(
-                    a in request_inputs for a in arg_names
-                ):
-                    inputs = [
-                        xr.open_dataset(group[name])[name] for name in input_names
-                    ]
-                    args = [
-                        single_input_or_none(request_inputs, name) for name in arg_names
-                    ]
-
-                    output = variable_computations[variable]["function"](
-                        *inputs, *args
-                    ).to_dataset(name=variable)
-                    output_file = Path(workdir) / f"{variable}_{output_basename}"
-                    dataset_to_netcdf(output, output_file)
-
-                    variables_to_compute.remove(variable)
-                    group[variable] = output_file
-                    if variable in required_variable_names:
-                        output_files_list.append(output_file)
-                    break
-            else:
+        available = frozenset(group)
+        if available not in plans:
+            plans[available] = plan = plan_computations(
+                required_variable_names, available
+            )
+            LOGGER.info("Computation plan: %s", plan)
+            if plan.extra:
                 raise RuntimeError(
-                    f"Cant compute intermediate variables {variables_to_compute}"
+                    f"Cant compute intermediate variables {set(plan.extra)}"
                 )
+        group_steps.append(plans[available].steps)
+
+    # All plans follow the dependencies of `variable_computations`, so their union does too
+    steps = set().union(*group_steps)
+    order = TopologicalSorter(
+        {v: set(variable_computations[v]["inputs"]) & steps for v in steps}
+    ).static_order()
+    with opened_datasets() as datasets:
+        for variable in order:
+            groups = [g for g, gs in zip(file_groups, group_steps) if variable in gs]
+            arg_names = variable_computations[variable]["args"]
+            missing = [a for a in arg_names if a not in request_inputs]
+            if missing:
+                raise RuntimeError(
+                    f"Cant compute intermediate variable {variable}, missing inputs {missing}"
+                )
+            args = [single_input_or_none(request_inputs, name) for name in arg_names]
+
+            output_files = _compute_variable(
+                variable, groups, args, Path(workdir), datasets
+            )
+            for group, output_file in zip(groups, output_files):
+                group[variable] = output_file
+                if variable in required_variable_names:
+                    output_files_list.append(output_file)
 
     return output_files_list
 
 
+def _compute_variable(
+    variable: str,
+    groups: list[dict[str, Path]],
+    args: list,
+    workdir: Path,
+    datasets: dict | None = None,
+) -> list[Path]:
+    """Compute an intermediate variable for many file groups, reusing cached outputs.
+
+    Input files are opened once and kept in `datasets`, when given, so that sources used
+    by many computations (ex: tasmax for tas and tasmax_per) are only opened once.
+    """
+    datasets = {} if datasets is None else datasets
+
+    def open_variable(path: Path, name: str) -> xr.DataArray:
+        if path not in datasets:
+            datasets[path] = xr.open_dataset(path)
+        return datasets[path][name]
+
+    computation = variable_computations[variable]
+    input_names = computation["inputs"]
+    output_files = []
+    to_compute = []
+    for group in groups:
+        first_variable = list(group)[0]
+        output_basename = group[first_variable].name.split("_", 1)[1]
+        output_file = workdir / f"{variable}_{output_basename}"
+        output_files.append(output_file)
+
+        cached = _intermediate_cache_path(
+            variable, [group[name] for name in input_names], args
+        )
+        if cached is not None and cached.exists():
+            LOGGER.info("Reusing cached %s from %s", variable, cached)
+            # Mark as recently used
+            cached.touch()
+            _link_or_copy(cached, output_file)
+        else:
+            to_compute.append((group, output_file, cached))
+
+    if not to_compute:
+        return output_files
+
+    inputs = [
+        [open_variable(group[name], name) for name in input_names]
+        for group, _, _ in to_compute
+    ]
+    if computation["function"] is _percentile_doy and len(inputs) > 1:
+        outputs = batched_percentile_doy([i for i, in inputs], *args)
+    else:
+        outputs = [computation["function"](*i, *args) for i in inputs]
+
+    for output, (_, output_file, cached) in zip(outputs, to_compute):
+        dataset_to_netcdf(output.to_dataset(name=variable), output_file)
+        if cached is not None:
+            _store_in_cache(output_file, cached)
+
+    return output_files
+
+
+def batched_percentile_doy(
+    variables: list[xr.DataArray], perc: int, max_bytes: int | str | None = None
+) -> list[xr.DataArray]:
+    """Compute the day-of-year percentiles of many members at once.
+
+    Members sharing the same time coordinate and shape are stacked along a new dimension
+    and the rolling windows are built once for the whole stack. Their spatial coordinates
+    may differ (e.g. gridpoints of different models), they are restored on the outputs.
+    The rolling windows of a stack must fit in `max_bytes` (defaults to dask's
+    `array.chunk-size`), larger ensembles are split in several stacks. Members that
+    can't be stacked with any other, or whose windows alone exceed the limit, are
+    computed individually.
+    """
+    batches: list[list[int]] = []
+    for i, var in enumerate(variables):
+        # The rolling windows of percentile_doy hold 5 copies of the data
+        budget = _max_chunk_elements(var.to_dataset(name="var"), max_bytes)
+        max_members = budget // (5 * var.size)
+        for batch in batches:
+            first = variables[batch[0]]
+            if (
+                len(batch) < max_members
+                and first.sizes == var.sizes
+                and first.indexes["time"].equals(var.indexes["time"])
+            ):
+                batch.append(i)
+                break
+        else:
+            batches.append([i])
+
+    outputs: list[xr.DataArray | None] = [None] * len(variables)
+    for batch in batches:
+        if len(batch) == 1:
+            outputs[batch[0]] = _percentile_doy(variables[batch[0]], perc)
+            continue
+
+        stacked = xr.concat(
+            [variables[i] for i in batch],
+            dim="_member",
+            join="override",
+            coords="minimal",
+            compat="override",
+        )
+        result = _percentile_doy(stacked, perc)
+        for n, i in enumerate(batch):
+            out = result.isel(_member=n, drop=True)
+            outputs[i] = out.assign_coords(
+                {
+                    name: coord
+                    for name, coord in variables[i].coords.items()
+                    if "time" not in coord.dims and set(coord.dims) <= set(out.dims)
+                }
+            )
+    return outputs
+
+
 def get_input_lists(needed: set, available: set):
     """From a list of dataset variables, get the source variable names to compute them."""
-    raw = available.intersection(needed)
-    unknown = needed.difference(raw)
-    compute = set()
-    extra = set()
-
-    while unknown:
-        for var in list(unknown):
-            if var in variable_computations:
-                this_needed = set(variable_computations[var]["inputs"])
-                compute.add(var)
-                unknown.remove(var)
-                raw.update(this_needed.intersection(available))
-                unknown.update(this_needed.difference(available))
-            else:
-                unknown.remove(var)
-                extra.add(var)
-    return raw, compute, extra
+    plan = plan_computations(needed, available)
+    return set(plan.raw), set(plan.steps), set(plan.extra)
 
 
 def ensemble_common_handler(  # noqa: C901,D103
@@ -548,26 +790,20 @@ def ensemble_common_handler(  # noqa: C901,D103
     dataset = get_datasets_config()[dataset_name]
 
     needed_variables = set(iter_xc_variables(process.xci))
-    avail_variables = set(dataset.allowed_values["variable"])
-    source_variables, computed_variables, extra_variables = get_input_lists(
-        needed_variables, avail_variables
-    )
+    plan = plan_computations(needed_variables, dataset.variables)
+    write_log(process, f"Computation plan: {plan}")
+    source_variables, extra_variables = set(plan.raw), set(plan.extra)
 
     scenarios = [r.data.strip() for r in request.inputs["scenario"]]
     models = [m.data.strip() for m in request.inputs["models"]]
 
     # Check if arguments are ok for this dataset
-    if not set(dataset.allowed_values["scenario"]).issuperset(scenarios):
+    if not dataset.scenarios.issuperset(scenarios):
         raise InvalidParameterValue(
             f"Invalid scenarios for dataset {dataset_name}. "
             f"Should be in {dataset.allowed_values['scenario']}."
         )
-    if (
-        not set(dataset.allowed_values["model"])
-        .union(dataset.model_lists.keys())
-        .union({"all"})
-        .issuperset(models)
-    ):
+    if not dataset.models.issuperset(models):
         raise InvalidParameterValue(
             f"Invalid models or model list for dataset {dataset_name}. "
             f"Should be in {dataset.allowed_values['model']} + {list(dataset.model_lists.keys())}"
@@ -607,10 +843,8 @@ def ensemble_common_handler(  # noqa: C901,D103
             bbox = dict(lat_bnds=[lat0, lat1], lon_bnds=[lon0, lon1])
             region = dict(name="region", method="bbox", **bbox)
         else:
-            shp = gpd.read_file(
-                Path(request.inputs[wpsio.shape.identifier][0].file)
-            ).to_crs("EPSG:4326")
-            shp["geometry"] = shp.make_valid()
+            # Shared with the subset step, through the geometries cache
+            shp = prepare_shape(Path(request.inputs[wpsio.shape.identifier][0].file))
             region = dict(name="region", method="shape", shape=shp)
     else:
         # average_dims = None
@@ -689,13 +923,22 @@ def ensemble_common_handler(  # noqa: C901,D103
                 f"Computing indices for file {n + 1} of {n_groups}, scen={scenario}",
                 subtask_percentage=n * 100 // n_groups,
             )
-            output_ds = compute_indices(process, process.xci, inputs)
-            for variable in needed_variables:
-                input_name = Path(inputs[variable][0].file).name
-                output_name = input_name.replace(variable, process.identifier)
+            with opened_datasets() as datasets:
+                output_ds = compute_indices(
+                    process, process.xci, inputs, datasets=datasets
+                )
+                for variable in needed_variables:
+                    input_name = inputs.sources[variable].name
+                    # Subsetted filenames are lowercase, while variable names might not be.
+                    output_name = re.sub(
+                        re.escape(variable),
+                        process.identifier,
+                        input_name,
+                        flags=re.IGNORECASE,
+                    )
 
-            output_path = Path(process.workdir) / output_name
-            dataset_to_netcdf(output_ds, output_path)
+                output_path = Path(process.workdir) / output_name
+                dataset_to_netcdf(output_ds, output_path)
             indices_files.append(output_path)
 
         warnings.filterwarnings("default", category=FutureWarning)
@@ -0,0 +1,460 @@
+# noqa: D100
+import logging
+import os
+from collections import OrderedDict
+from collections.abc import Callable
+from datetime import datetime
+from hashlib import sha256
+from pathlib import Path
+from threading import Lock
+from typing import Any, TypeVar
+
+import cf_xarray  # noqa: F401
+import geopandas as gpd
+import numpy as np
+import scipy.sparse
+import shapely
+import xarray as xr
+from clisops.core.subset import create_mask, get_lat, get_lon
+
+from .utils import get_cache_dir, prune_cache
+
+LOGGER = logging.getLogger("PYWPS")
+
+T = TypeVar("T")
+
+WGS84 = "EPSG:4326"
+# WGS84 with longitudes between 0 and 360
+WGS84_WRAPPED = "+proj=longlat +ellps=WGS84 +datum=WGS84 +no_defs lon_wrap=180"
+
+# Weights and masks of the last used (grid, geometries) pairs, in memory
+_memory: OrderedDict[tuple[str, str], Any] = OrderedDict()
+_memory_lock = Lock()
+_key_locks: dict[tuple[str, str], Lock] = {}
+MAX_IN_MEMORY = 32
+MAX_ON_DISK = 1000
+
+
+def extract_shp(path):
+    """Return a geopandas-compatible path to the shapefile stored in a zip archive.
+
+    If multiple shapefiles are included, return only the first one found.
+
+    Parameters
+    ----------
+    path : Path
+      Path to zip archive holding shapefile.
+
+    Returns
+    -------
+    str
+      zip:///<path to zip file>!<relative path to shapefile>
+    """
+    from zipfile import ZipFile
+
+    z = ZipFile(path)
+
+    fn = next(filter(lambda x: x.endswith(".shp"), z.namelist()))
+    z.close()
+
+    return f"zip://{path.absolute()}!{fn}"
+
+
+def read_shape(path: Path | str) -> gpd.GeoDataFrame:
+    """Read geometries in WGS84.
+
+    Like clisops, geometries without a CRS are assumed to be in WGS84, with longitudes
+    in [0, 360] if they are out of [-180, 180].
+    """
+    shape = gpd.read_file(path)
+    if shape.crs is None:
+        minx, _, maxx, _ = shape.total_bounds
+        if minx >= -180 and maxx <= 180:
+            return shape.set_crs(WGS84)
+        return shape.set_crs(WGS84_WRAPPED).to_crs(WGS84)
+    return shape.to_crs(WGS84)
+
+
+def _with_index(shape: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    # The spatial index is built lazily by geopandas and kept with the GeoDataFrame
+    shape.sindex
+    return shape
+
+
+def prepare_shape(path: Path, tolerance: float | None = 0) -> gpd.GeoDataFrame:
+    """Read uploaded geometries (a zipped shapefile or any format read by geopandas).
+
+    Geometries are reprojected to WGS84 (see :py:func:`read_shape`), made valid and
+    simplified with the given `tolerance`, and their spatial index is built.
+    This is done once per file content and tolerance, the result is kept in memory and
+    in the "shapes" cache. The returned GeoDataFrame is shared and must not be modified.
+    """
+    path = Path(path)
+    tolerance = tolerance or 0
+    key = sha256(path.read_bytes() + repr(tolerance).encode()).hexdigest()[:32]
+
+    def compute():
+        shape = read_shape(extract_shp(path) if path.suffix == ".zip" else path)
+        shape["geometry"] = shape.make_valid()
+        if tolerance > 0:
+            shape["geometry"] = shape.simplify(tolerance)
+        return _with_index(shape)
+
+    return _cached(
+        "shapes",
+        key,
+        compute=compute,
+        load=lambda p: _with_index(gpd.read_file(p)),
+        # GeoPackage reserves a "fid" column, name it so that a shapefile FID is kept
+        save=lambda shape, p: shape.to_file(p, driver="GPKG", FID="finch_gpkg_fid"),
+        suffix=".gpkg",
+    )
+
+
+def spatial_dims(ds: xr.Dataset | xr.DataArray) -> tuple[str, str]:
+    """Return the names of the (y, x) dimensions of the grid."""
+    lat, lon = ds.cf["latitude"], ds.cf["longitude"]
+    if lat.ndim == 1:
+        return lat.dims[0], lon.dims[0]
+    return lat.dims
+
+
+def grid_signature(ds: xr.Dataset | xr.DataArray) -> str:
+    """Return a hash of the cell coordinates of a dataset."""
+    h = sha256()
+    for coord in (ds.cf["latitude"], ds.cf["longitude"]):
+        h.update(repr(coord.dims).encode())
+        h.update(np.ascontiguousarray(coord.values, dtype="float64").tobytes())
+    return h.hexdigest()[:32]
+
+
+def geometry_signature(shape: gpd.GeoDataFrame | gpd.GeoSeries) -> str:
+    """Return a hash of geometries, including their coordinate reference system."""
+    h = sha256(str(shape.crs).encode())
+    for wkb in shapely.to_wkb(np.asarray(shape.geometry), hex=False):
+        h.update(wkb)
+    return h.hexdigest()[:32]
+
+
+def crop_to_shape(
+    ds: xr.Dataset,
+    shape: gpd.GeoDataFrame | gpd.GeoSeries,
+    buffer: float | None = None,
+) -> xr.Dataset:
+    """Crop a dataset to the bounding box of geometries, extended by `buffer` degrees.
+
+    The selection is done by index, so that only the enclosing hyperslab is read from
+    lazily opened (ex: OPeNDAP) datasets. The buffer defaults to the largest grid spacing,
+    so that cells partially overlapping the geometries are kept.
+    The dataset is returned as is if no cell center is in the extended bounding box.
+    """
+    lat, lon = ds.cf["latitude"], ds.cf["longitude"]
+    if buffer is None:
+        buffer = max(
+            (
+                float(np.abs(np.diff(c.values, axis=axis)).max())
+                for c in (lat, lon)
+                for axis in range(c.ndim)
+                if c.shape[axis] > 1
+            ),
+            default=0,
+        )
+
+    minx, miny, maxx, maxy = shape.total_bounds
+    # Compare longitudes in [-180, 180], like the geometries
+    lon_values = (lon + 180) % 360 - 180
+    inside = (
+        (lat >= miny - buffer)
+        & (lat <= maxy + buffer)
+        & (lon_values >= minx - buffer)
+        & (lon_values <= maxx + buffer)
+    )
+    if not inside.any():
+        return ds
+
+    indexers = {}
+    for dim in spatial_dims(ds):
+        (index,) = np.nonzero(inside.any([d for d in inside.dims if d != dim]).values)
+        indexers[dim] = slice(int(index[0]), int(index[-1]) + 1)
+    return ds.isel(indexers)
+
+
+def _edges(centers: np.ndarray) -> np.ndarray:
+    """Return the n + 1 edges of n cell centers, extrapolating the outer edges."""
+    if centers.size == 1:
+        # A single cell: assume a 1 degree width
+        return np.array([centers[0] - 0.5, centers[0] + 0.5])
+    mid = (centers[1:] + centers[:-1]) / 2
+    return np.concatenate([[2 * centers[0] - mid[0]], mid, [2 * centers[-1] - mid[-1]]])
+
+
+def _corners(centers: np.ndarray) -> np.ndarray:
+    """Return the (ny + 1, nx + 1) corners of 2D cell centers."""
+    ny, nx = centers.shape
+    if ny < 2 or nx < 2:
+        raise ValueError("Curvilinear grids need at least two cells along each axis.")
+    padded = np.empty((ny + 2, nx + 2))
+    padded[1:-1, 1:-1] = centers
+    padded[0, 1:-1] = 2 * centers[0] - centers[1]
+    padded[-1, 1:-1] = 2 * centers[-1] - centers[-2]
+    padded[:, 0] = 2 * padded[:, 1] - padded[:, 2]
+    padded[:, -1] = 2 * padded[:, -2] - padded[:, -3]
+    return (padded[:-1, :-1] + padded[1:, :-1] + padded[:-1, 1:] + padded[1:, 1:]) / 4
+
+
+def cell_polygons(ds: xr.Dataset | xr.DataArray) -> np.ndarray:
+    """Return the cells of the grid of a dataset as shapely polygons, flattened in C order.
+
+    Cells are shifted by multiples of 360 degrees so that their centers are in [-180, 180],
+    like the geometries returned by :py:func:`read_shape`.
+    """
+    lat = ds.cf["latitude"].values
+    lon = ds.cf["longitude"].values
+    if lat.ndim == 1:
+        lon_corners, lat_corners = np.meshgrid(_edges(lon), _edges(lat))
+        lon = np.broadcast_to(lon, (lat.size, lon.size))
+    else:
+        lat_corners, lon_corners = _corners(lat), _corners(lon)
+    # Same normalization as in `crop_to_shape`, applied to the centers so cells stay whole
+    shift = ((lon + 180) % 360 - 180 - lon).ravel()
+
+    # Corners of each cell, counterclockwise from the lower left one
+    ring = [
+        (slice(None, -1), slice(None, -1)),
+        (slice(None, -1), slice(1, None)),
+        (slice(1, None), slice(1, None)),
+        (slice(1, None), slice(None, -1)),
+    ]
+    coords = np.stack(
+        [
+            np.stack([lon_corners[r].ravel() + shift, lat_corners[r].ravel()], axis=-1)
+            for r in ring
+        ],
+        axis=1,
+    )
+    return shapely.polygons(coords)
+
+
+def compute_weights(
+    ds: xr.Dataset | xr.DataArray, shape: gpd.GeoDataFrame | gpd.GeoSeries
+) -> scipy.sparse.csr_array:
+    """Compute the weights of the grid cells in each geometry, as a (geometries, cells) sparse matrix.
+
+    The weight of a cell is the area of its overlap with the geometry, in squared degrees,
+    times the cosine of the latitude of the cell center to approximate its area on the sphere.
+    Geometries must be in the coordinates of the grid (EPSG:4326 for lat/lon grids).
+    """
+    cells = cell_polygons(ds)
+    lat = ds.cf["latitude"].values
+    if lat.ndim == 1:
+        lat = np.repeat(lat, ds.cf["longitude"].size)
+    cos_lat = np.cos(np.deg2rad(lat.ravel()))
+
+    # All (geometry, cell) pairs at once, so that many geometries are handled in one pass
+    geoms = np.asarray(shape.geometry)
+    rows, cols = shapely.STRtree(cells).query(geoms, predicate="intersects")
+    area = shapely.area(shapely.intersection(cells[cols], geoms[rows]))
+    keep = area > 0
+
+    return scipy.sparse.csr_array(
+        (area[keep] * cos_lat[cols[keep]], (rows[keep], cols[keep])),
+        shape=(len(shape), cells.size),
+    )
+
+
+def _cached(
+    kind: str,
+    key: str,
+    compute: Callable[[], T],
+    load: Callable[[Path], T],
+    save: Callable[[T, Path], None],
+    suffix: str,
+) -> T:
+    """Return an object computed once per key.
+
+    Objects are kept in memory for the `MAX_IN_MEMORY` last used keys, and on disk in the
+    `kind` cache when `cache_dir` is configured, up to `MAX_ON_DISK` files per kind.
+    Concurrent calls with the same key wait for the first one instead of computing again.
+    """
+    memory_key = (kind, key)
+    with _memory_lock:
+        if memory_key in _memory:
+            _memory.move_to_end(memory_key)
+            return _memory[memory_key]
+        key_lock = _key_locks.setdefault(memory_key, Lock())
+
+    with key_lock:
+        try:
+            with _memory_lock:
+                if memory_key in _memory:
+                    return _memory[memory_key]
+
+            cache = get_cache_dir(kind)
+            path = cache / f"{key}{suffix}" if cache is not None else None
+            if path is not None and path.exists():
+                obj = load(path)
+                # Mark as recently used
+                path.touch()
+            else:
+                obj = compute()
+                if path is not None:
+                    # Write under a temporary name, so concurrent requests never read
+                    # partial files
+                    tmp = path.with_name(f"{key}.{os.getpid()}.tmp{suffix}")
+                    save(obj, tmp)
+                    tmp.replace(path)
+                    prune_cache(cache, f"*{suffix}", MAX_ON_DISK)
+
+            with _memory_lock:
+                _memory[memory_key] = obj
+                while len(_memory) > MAX_IN_MEMORY:
+                    _memory.popitem(last=False)
+        finally:
+            # Also on errors and when another call computed the object meanwhile
+            with _memory_lock:
+                _key_locks.pop(memory_key, None)
+    return obj
+
+
+def polygon_weights(
+    ds: xr.Dataset | xr.DataArray, shape: gpd.GeoDataFrame | gpd.GeoSeries
+) -> scipy.sparse.csr_array:
+    """Return the weights of the grid cells in each geometry, see :py:func:`compute_weights`.
+
+    Weights are computed once per grid and geometries, and cached in the "weights" cache.
+    """
+    return _cached(
+        "weights",
+        f"{grid_signature(ds)}_{geometry_signature(shape)}",
+        compute=lambda: compute_weights(ds, shape),
+        load=lambda path: scipy.sparse.csr_array(scipy.sparse.load_npz(path)),
+        save=lambda weights, path: scipy.sparse.save_npz(path, weights),
+        suffix=".npz",
+    )
+
+
+def compute_mask(
+    ds: xr.Dataset | xr.DataArray, shape: gpd.GeoDataFrame | gpd.GeoSeries
+) -> xr.DataArray:
+    """Rasterize geometries on the grid of a dataset, as done by clisops' `subset_shape`.
+
+    Cells whose center is in a geometry are 1, others are NaN.
+    """
+    lon = get_lon(ds)
+    wrap_lons = bool(
+        (lon.min() >= 0 and lon.max() <= 360)
+        and not (lon.min() >= -180 and lon.max() <= 180)
+    )
+    return create_mask(
+        x_dim=lon, y_dim=get_lat(ds), poly=shape, wrap_lons=wrap_lons
+    ).clip(1, 1)
+
+
+def polygon_mask(
+    ds: xr.Dataset | xr.DataArray, shape: gpd.GeoDataFrame | gpd.GeoSeries
+) -> xr.DataArray:
+    """Return the mask of geometries on the grid of a dataset, see :py:func:`compute_mask`.
+
+    Masks are computed once per grid and geometries, and cached in the "masks" cache.
+    """
+    return _cached(
+        "masks",
+        f"{grid_signature(ds)}_{geometry_signature(shape)}",
+        compute=lambda: compute_mask(ds, shape),
+        load=lambda path: xr.load_dataarray(path),
+        save=lambda mask, path: mask.to_netcdf(path),
+        suffix=".nc",
+    )
+
+
+def _weighted_mean(
+    data: np.ndarray, weights: scipy.sparse.csr_array, skipna: bool
+) -> np.ndarray:
+    """Average the last two (spatial) axes of `data` with the weights of each geometry."""
+    leading = data.shape[:-2]
+    flat = data.reshape(-1, data.shape[-2] * data.shape[-1]).T
+    valid = ~np.isnan(flat)
+    total = weights @ np.where(valid, flat, 0)
+    if skipna:
+        # Renormalize by the weights of the valid cells
+        norm = weights @ valid.astype(float)
+    else:
+        norm = np.broadcast_to(weights.sum(axis=1)[:, np.newaxis], total.shape)
+        total = np.where(weights @ (~valid).astype(float) > 0, np.nan, total)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        out = np.where(norm > 0, total / norm, np.nan)
+    return out.T.reshape(*leading, weights.shape[0])
+
+
+def spatial_average(
+    ds: xr.Dataset,
+    shape: gpd.GeoDataFrame,
+    skipna: bool = True,
+    weights: scipy.sparse.csr_array | None = None,
+    squeeze: bool = True,
+) -> xr.Dataset:
+    """Average a dataset over each geometry of a GeoDataFrame.
+
+    Values are averaged with the cell overlap weights of :py:func:`polygon_weights`,
+    applied as a sparse matrix product over spatial blocks of the data. With `skipna`,
+    missing values are left out and the weights renormalized.
+    The output has a `geom` dimension, which is squeezed when there is a single geometry
+    and `squeeze` is True.
+    Columns of the GeoDataFrame are added as coordinates along `geom`.
+    """
+    if weights is None:
+        weights = polygon_weights(ds, shape)
+    ydim, xdim = spatial_dims(ds)
+    if ds.chunks:
+        ds = ds.chunk({ydim: -1, xdim: -1})
+
+    out = xr.Dataset(attrs=ds.attrs)
+    for name, da in ds.data_vars.items():
+        if ydim not in da.dims or xdim not in da.dims:
+            continue
+        out[name] = xr.apply_ufunc(
+            _weighted_mean,
+            da,
+            input_core_dims=[[ydim, xdim]],
+            output_core_dims=[["geom"]],
+            kwargs={"weights": weights, "skipna": skipna},
+            dask="parallelized",
+            output_dtypes=[np.float64],
+            dask_gufunc_kwargs={"output_sizes": {"geom": weights.shape[0]}},
+            keep_attrs=True,
+        )
+
+    out = out.assign_coords(
+        {
+            "geom": xr.DataArray(np.asarray(shape.index), dims=("geom",)),
+            **{
+                col: xr.DataArray(shape[col].values, dims=("geom",))
+                for col in shape.columns
+                if col != "geometry"
+            },
+        }
+    )
+    if squeeze and len(shape) == 1:
+        out = out.squeeze("geom")
+
+    out.attrs["history"] = (
+        f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] "
+        f"spatial average over {len(shape)} polygons with overlap weights\n"
+        f"{ds.attrs.get('history', '')}"
+    )
+    return out
+
+
+def region_shape(region: dict) -> gpd.GeoDataFrame:
+    """Return the geometries of a region definition, as used by `xscen.aggregate.spatial_mean`."""
+    if region["method"] == "bbox":
+        geom = shapely.box(
+            region["lon_bnds"][0],
+            region["lat_bnds"][0],
+            region["lon_bnds"][1],
+            region["lat_bnds"][1],
+        )
+        return gpd.GeoDataFrame(index=[0], geometry=[geom], crs="EPSG:4326")
+    if region["method"] == "shape":
+        return region["shape"]
+    raise ValueError(f"Unknown region method: {region['method']}")
@@ -5,16 +5,21 @@ from threading import Lock
 from urllib.parse import urlparse
 
 import geopandas as gpd
-from clisops.core.average import average_shape
-from clisops.core.subset import subset_bbox, subset_gridpoint, subset_shape, subset_time
+import numpy as np
+import xarray as xr
+from clisops.core.subset import subset_bbox, subset_gridpoint, subset_time
 from pywps import ComplexInput, Process
 from pywps.app.exceptions import ProcessError
 
 from . import wpsio
+from .polygons import crop_to_shape
+from .polygons import extract_shp as extract_shp  # moved, re-exported for compatibility
+from .polygons import polygon_mask, polygon_weights, prepare_shape, spatial_average
 from .utils import (
     RequestInputs,
     dataset_to_netcdf,
     make_metalink_output,
+    prefetch_inputs,
     process_threaded,
     single_input_or_none,
     try_opendap,
@@ -202,29 +207,67 @@ def finch_subset_bbox(
     return output_files
 
 
-def extract_shp(path):
-    """Return a geopandas-compatible path to the shapefile stored in a zip archive.
+def subset_shape(
+    ds: xr.Dataset,
+    shape: gpd.GeoDataFrame,
+    start_date: str | None = None,
+    end_date: str | None = None,
+) -> xr.Dataset:
+    """Subset a dataset to geometries in WGS84, masking cells outside of them.
 
-    If multiple shapefiles are included, return only the first one found.
+    Same as clisops' `subset_shape`, with the rasterization of the geometries done once
+    per grid (see :py:func:`polygon_mask`), instead of once per file.
+    """
+    ds = ds.copy()
+    minx, miny, maxx, maxy = shape.total_bounds
+    if miny < -90 or maxy > 90:
+        raise ValueError("Latitudes exceed domain of WGS84 coordinate system.")
+    if minx < -180 or maxx > 180:
+        raise ValueError("Longitudes exceed domain of WGS84 coordinate system.")
 
-    Parameters
-    ----------
-    path : Path
-      Path to zip archive holding shapefile.
+    try:
+        ds = subset_bbox(ds, lon_bnds=(minx, maxx), lat_bnds=(miny, maxy))
+    except ValueError as e:
+        raise ValueError(
+            "No grid cell centroids found within provided polygon bounding box."
+        ) from e
+    except NotImplementedError:
+        LOGGER.info(
+            "The bounding box crosses the prime meridian, skipping bbox subset."
+        )
 
-    Returns
-    -------
-    str
-      zip:///<path to zip file>!<relative path to shapefile>
-    """
-    from zipfile import ZipFile
+    if start_date or end_date:
+        ds = subset_time(ds, start_date=start_date, end_date=end_date)
 
-    z = ZipFile(path)
+    mask_2d = polygon_mask(ds, shape)
+    if np.all(mask_2d.isnull()):
+        raise ValueError(
+            f"No grid cell centroids found within provided polygon bounds ({shape.bounds})."
+        )
+
+    sp_dims = set(mask_2d.dims)
+    if len(sp_dims) > 1:
+        # Keep the cells between the shapes, only drop the outer ones
+        inner_mask = xr.full_like(mask_2d, True, dtype=bool)
+        for dim in sp_dims:
+            left = mask_2d.bfill(dim).sum(sp_dims - {dim})
+            right = mask_2d.ffill(dim).sum(sp_dims - {dim})
+            inner_mask = inner_mask & (left != 0) & (right != 0)
+        inner_mask = mask_2d.notnull() | inner_mask
+    else:
+        inner_mask = mask_2d.notnull()
 
-    fn = next(filter(lambda x: x.endswith(".shp"), z.namelist()))
-    z.close()
+    for v in ds.data_vars:
+        if sp_dims.issubset(ds[v].dims):
+            ds[v] = ds[v].where(mask_2d.notnull())
 
-    return f"zip://{path.absolute()}!{fn}"
+    if sp_dims.issubset(ds.coords.keys()):
+        mask_2d = mask_2d.where(inner_mask, drop=True)
+        for dim in sp_dims:
+            ds = ds.sel({dim: mask_2d[dim]})
+    else:
+        ds = ds.where(inner_mask, drop=True)
+    return ds
 
 
 def finch_average_shape(
@@ -240,42 +283,53 @@ def finch_average_shape(
      - end_date: Final date for temporal subsetting.
     """
     shp = Path(request_inputs[wpsio.shape.identifier][0].file)
-    if shp.suffix == ".zip":
-        shp = extract_shp(shp)
-
     start_date = single_input_or_none(request_inputs, wpsio.start_date.identifier)
     end_date = single_input_or_none(request_inputs, wpsio.end_date.identifier)
     tolerance = single_input_or_none(request_inputs, wpsio.tolerance.identifier)
     variables = [r.data for r in request_inputs.get("variable", [])]
 
-    shape = gpd.read_file(shp)
-    if tolerance > 0:
-        shape["geometry"] = shape.simplify(tolerance)
+    shape = prepare_shape(shp, tolerance=tolerance)
 
     n_files = len(netcdf_inputs)
     count = 0
 
     output_files = []
 
-    for resource in netcdf_inputs:
+    lock = Lock()
+
+    def _average(resource):
+        nonlocal count
+
         # if not subsetting by time, it's not necessary to decode times
         time_subset = start_date is not None or end_date is not None
-        dataset = try_opendap(
-            resource, decode_times=time_subset, chunk_dims=["time", "realization"]
-        )
+        dataset = try_opendap(resource, decode_times=time_subset, operation="space")
 
-        count += 1
-        write_log(
-            process,
-            f"Averaging file {count} of {n_files} ({getattr(resource, resource.prop)})",
-            subtask_percentage=(count - 1) * 100 // n_files,
-        )
+        with lock:
+            count += 1
+            write_log(
+                process,
+                f"Averaging file {count} of {n_files} ({getattr(resource, resource.prop)})",
+                subtask_percentage=(count - 1) * 100 // n_files,
+            )
 
         dataset = dataset[variables] if variables else dataset
 
         if time_subset:
             dataset = subset_time(dataset, start_date=start_date, end_date=end_date)
-        averaged = average_shape(dataset, shape)
+
+        # Only read the data around the geometries
+        dataset = crop_to_shape(dataset, shape)
+
+        # Members of a dataset share their grid, weights are only computed for the first one
+        weights = polygon_weights(dataset, shape)
+        if weights.nnz == 0:
+            raise ValueError(
+                "There were no valid data points found in the requested averaging region. "
+                "Verify objects overlap."
+            )
+        averaged = spatial_average(
+            dataset, shape, skipna=False, weights=weights, squeeze=False
+        )
 
         if not all(averaged.dims.values()):
             msg = f"Average is empty for dataset: {resource.url}"
@@ -285,10 +339,13 @@ def finch_average_shape(
         p = make_subset_file_name(resource, kind="avg")
         output_filename = Path(process.workdir) / p
 
-        dataset_to_netcdf(averaged, output_filename)
+        # Averages are computed by blocks of time, and written as they are computed
+        dataset_to_netcdf(averaged, output_filename, stream=True)
 
         output_files.append(output_filename)
 
+    process_threaded(_average, netcdf_inputs)
+
     return output_files
 
 
@@ -305,13 +362,13 @@ def finch_subset_shape(
      - end_date: Final date for temporal subsetting.
     """
     shp = Path(request_inputs[wpsio.shape.identifier][0].file)
-    if shp.suffix == ".zip":
-        shp = extract_shp(shp)
-
     start_date = single_input_or_none(request_inputs, wpsio.start_date.identifier)
     end_date = single_input_or_none(request_inputs, wpsio.end_date.identifier)
     variables = [r.data for r in request_inputs.get("variable", [])]
 
+    # Read once for all files
+    shape = prepare_shape(shp)
+
     n_files = len(netcdf_inputs)
     count = 0
 
@@ -338,7 +395,7 @@ def finch_subset_shape(
 
         subsetted = subset_shape(
             dataset,
-            shape=shp,
+            shape=shape,
             start_date=start_date,
             end_date=end_date,
         )
@@ -373,6 +430,8 @@ def common_subset_handler(  # noqa: D103
 
     write_log(process, "Processing started", process_step="start")
 
+    prefetch_inputs(process, request.inputs["resource"])
+
     output_files = subset_function(
         process,
         netcdf_inputs=request.inputs["resource"],
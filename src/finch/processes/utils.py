@@ -1,27 +1,39 @@
 # noqa: D100
 import json
 import logging
-import urllib.request
+import os
+import time
 import zipfile
 from collections import deque
-from collections.abc import Callable, Generator, Iterable
+from collections.abc import Callable, Generator, Iterable, Mapping
+from contextlib import contextmanager, suppress
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta
+from functools import cached_property, reduce
+from hashlib import sha256
 from itertools import chain
 from multiprocessing.pool import ThreadPool
+from operator import mul
 from pathlib import Path
+from threading import Lock
+from types import MappingProxyType
 from typing import Any
-from urllib.error import URLError
 from urllib.parse import urlparse, urlunparse
 
 import cftime
+import dask
 import numpy as np
 import pandas as pd
+import parse
+import requests
 import sentry_sdk
 import xarray as xr
 import xclim
 import xclim.core.options as xclim_options
 import yaml
+from dask.system import CPU_COUNT
+from distributed import Client
+from distributed.system import MEMORY_LIMIT
 from netCDF4 import num2date
 from pandas.api.types import is_numeric_dtype  # noqa
 from pywps import (
@@ -36,7 +48,9 @@ from pywps import (
     configuration,
 )
 from pywps.configuration import get_config_value
+from pywps.exceptions import FileSizeExceeded
 from pywps.inout.outputs import MetaFile, MetaLink4
+from requests.adapters import HTTPAdapter
 from slugify import slugify
 from xclim.core import formatting
 from xclim.core.indicator import build_indicator_module_from_yaml
@@ -44,6 +58,9 @@ from xclim.core.utils import InputKind
 
 LOGGER = logging.getLogger("PYWPS")
 
+# Maximum number of files kept in the downloads cache
+MAX_DOWNLOADS = 1000
+
 PywpsInput = LiteralInput | ComplexInput | BoundingBoxInput
 PywpsOutput = LiteralOutput | ComplexOutput | BoundingBoxOutput
 RequestInputs = dict[str, deque[PywpsInput]]
@@ -110,23 +127,83 @@ class DatasetConfiguration:
     suffix: str = "*nc"
     model_lists: dict = field(default_factory=dict)
 
+    @cached_property
+    def variables(self) -> frozenset[str]:
+        """Variables available in this dataset."""
+        return frozenset(self.allowed_values["variable"])
+
+    @cached_property
+    def scenarios(self) -> frozenset[str]:
+        """Scenarios available in this dataset."""
+        return frozenset(self.allowed_values["scenario"])
+
+    @cached_property
+    def models(self) -> frozenset[str]:
+        """Models available in this dataset, including the names of the model lists and "all"."""
+        return frozenset(self.allowed_values["model"]).union(
+            self.model_lists.keys(), {"all"}
+        )
+
+    @cached_property
+    def parser(self) -> parse.Parser:
+        """Compiled filename pattern."""
+        return parse.compile(self.pattern)
+
+    @cached_property
+    def resolved_model_lists(self) -> dict[str, list[str | tuple[str, str]]]:
+        """Model lists keyed by their lowercase name, with realization specs as tuples."""
+        return {
+            name.lower(): [m if isinstance(m, str) else tuple(m) for m in models]
+            for name, models in self.model_lists.items()
+        }
+
+    def resolve_models(
+        self, models: list[str] | None
+    ) -> list[str | tuple[str, str]] | None:
+        """Replace a model list name by its members. Returns None if all models are requested."""
+        if not models or models[0].lower() == "all":
+            return None
+        if len(models) == 1 and models[0].lower() in self.resolved_model_lists:
+            return self.resolved_model_lists[models[0].lower()]
+        return models
+
+
+# Parsed datasets configurations, keyed by path, along with the file's modification time.
+_datasets_config_cache: dict[Path, tuple[int, dict[str, DatasetConfiguration]]] = {}
+_datasets_config_lock = Lock()
+
+
+def get_datasets_config() -> dict[str, DatasetConfiguration]:
+    """Return the ensemble datasets configuration.
 
-def get_datasets_config():  # noqa: D103
+    The YAML file is parsed once and kept in memory. It is parsed again whenever its
+    modification time changes, so edits are picked up without restarting the workers.
+    """
     p = get_config_value("finch", "datasets_config")
     if not p:  # No config given.
         return {}
 
     if not Path(p).is_absolute():
         p = Path(__file__).parent.parent / p
-
-    with Path(p).open() as f:
-        conf = yaml.safe_load(f)
-    return {ds: DatasetConfiguration(**dsconf) for ds, dsconf in conf.items()}
+    p = Path(p).resolve()
+
+    mtime = p.stat().st_mtime_ns
+    with _datasets_config_lock:
+        cached = _datasets_config_cache.get(p)
+        if cached is None or cached[0] != mtime:
+            with p.open() as f:
+                conf = yaml.safe_load(f)
+            cached = (
+                mtime,
+                {ds: DatasetConfiguration(**dsconf) for ds, dsconf in conf.items()},
+            )
+            _datasets_config_cache[p] = cached
+    return dict(cached[1])
 
 
 def get_available_variables():  # noqa: D103
     conf = get_datasets_config()
-    return set(chain(*(d.allowed_values["variable"] for d in conf.values())))
+    return set(chain(*(d.variables for d in conf.values())))
 
 
 def iter_xc_variables(indicator: xclim.core.indicator.Indicator):  # noqa: D103
@@ -206,50 +283,81 @@ def get_attributes_from_config():
     }
 
 
+@dataclass(frozen=True, slots=True)
+class IndicatorArguments:
+    """Resolved arguments of an indicator call.
+
+    `kwargs` holds the values of the literal and JSON inputs, `sources` the netCDF inputs,
+    either as pywps inputs or as paths to local files. Members of an ensemble only differ
+    by their files: the arguments are resolved once per request and combined with each
+    member's files with :py:meth:`with_files`, without copying the request inputs.
+    """
+
+    kwargs: Mapping[str, Any]
+    sources: Mapping[str, ComplexInput | Path]
+
+    @classmethod
+    def from_inputs(cls, inputs: RequestInputs) -> "IndicatorArguments":
+        """Resolve the arguments from the inputs of a pywps request."""
+        kwargs = {}
+        sources = {}
+        for name, input_queue in inputs.items():
+            input = input_queue[0]
+            if isinstance(input, LiteralInput):
+                value = [inp.data for inp in input_queue]
+                kwargs[name] = value[0] if len(input_queue) == 1 else value
+            elif isinstance(input, ComplexInput):
+                if input.supported_formats[0] == FORMATS.JSON:
+                    kwargs[name] = json.loads(input.data)
+                elif input.supported_formats[0] in [FORMATS.NETCDF, FORMATS.DODS]:
+                    sources[name] = input
+        return cls(MappingProxyType(kwargs), MappingProxyType(sources))
+
+    def with_files(self, files: Mapping[str, Path]) -> "IndicatorArguments":
+        """Return the same arguments, with the given netCDF files as sources."""
+        return IndicatorArguments(
+            self.kwargs, MappingProxyType({**self.sources, **files})
+        )
+
+
 def compute_indices(  # noqa: D103
-    process: Process, func: Callable, inputs: RequestInputs
+    process: Process,
+    func: Callable,
+    inputs: RequestInputs | IndicatorArguments,
+    datasets: dict[tuple, xr.Dataset] | None = None,
 ) -> xr.Dataset:
-    kwds = {}
-    global_attributes = {}
-    for name, input_queue in inputs.items():
-        if isinstance(input_queue[0], LiteralInput):
-            value = [inp.data for inp in input_queue]
-            if len(input_queue) == 1:
-                value = value[0]
-            kwds[name] = value
+    if not isinstance(inputs, IndicatorArguments):
+        inputs = IndicatorArguments.from_inputs(inputs)
 
+    kwds = dict(inputs.kwargs)
+    global_attributes = {}
     variable = kwds.pop("variable", None)
 
-    for name, input_queue in inputs.items():
-        input = input_queue[0]
+    for name, input in inputs.sources.items():
+        ds = try_opendap(
+            input,
+            logging_function=lambda msg: write_log(process, msg),
+            cache=datasets,
+        )
+        global_attributes = global_attributes or ds.attrs
+        vars = list(ds.data_vars.values())
 
-        if isinstance(input, ComplexInput):
-            if input.supported_formats[0] == FORMATS.JSON:
-                kwds[name] = json.loads(input.data)
+        if variable:
+            if variable in ds.data_vars:
+                kwds[name] = ds.data_vars[variable]
 
-            elif input.supported_formats[0] in [FORMATS.NETCDF, FORMATS.DODS]:
-                ds = try_opendap(
-                    input, logging_function=lambda msg: write_log(process, msg)
+            else:
+                raise KeyError(
+                    f"Variable name '{name}' not in data_vars {list(ds.data_vars)}"
                 )
-                global_attributes = global_attributes or ds.attrs
-                vars = list(ds.data_vars.values())
-
-                if variable:
-                    if variable in ds.data_vars:
-                        kwds[name] = ds.data_vars[variable]
-
-                    else:
-                        raise KeyError(
-                            f"Variable name '{name}' not in data_vars {list(ds.data_vars)}"
-                        )
-                else:
-                    # Get variable matching input parameter name.
-                    if name in ds.data_vars:
-                        kwds[name] = ds.data_vars[name]
-
-                    # If only one variable in dataset, use it.
-                    elif len(vars) == 1:
-                        kwds[name] = vars[0]
+        else:
+            # Get variable matching input parameter name.
+            if name in ds.data_vars:
+                kwds[name] = ds.data_vars[name]
+
+            # If only one variable in dataset, use it.
+            elif len(vars) == 1:
+                kwds[name] = vars[0]
 
     user_attrs = get_attributes_from_config()
 
@@ -386,33 +494,65 @@ def drs_filename(ds: xr.Dataset, variable: str | None = None):
 
 
 def try_opendap(
-    input: ComplexInput,
+    input: ComplexInput | Path,
     *,
     chunks="auto",
     decode_times=True,
     chunk_dims=None,
+    operation=None,
     logging_function=lambda message: None,
+    cache: dict[tuple, xr.Dataset] | None = None,
 ) -> xr.Dataset:
     """Try to open the file as an OPeNDAP url and chunk it.
 
+    The input can also be the path of a local file.
+
     By default, chunks are to be determined by xarray/dask.
-    If `chunks=None` or `chunks_dims` is given, finch rechunks the dataset according to
-    the logic of `chunk_dataset`.
+    If `chunks=None`, or `chunk_dims` or `operation` is given, finch rechunks the dataset
+    according to the logic of `chunk_dataset`.
     Pass `chunks=False` to disable dask entirely on this dataset.
+
+    If a `cache` mapping is given (see :py:func:`opened_datasets`), inputs pointing to the
+    same file or url, opened with the same options, share a single dataset.
     """
-    url = input.url
-    logging_function(f"Try opening DAP link {url}")
+    if cache is not None:
+        key = (
+            _dataset_key(input),
+            repr(chunks),
+            decode_times,
+            repr(chunk_dims),
+            operation,
+        )
+        if key not in cache:
+            cache[key] = try_opendap(
+                input,
+                chunks=chunks,
+                decode_times=decode_times,
+                chunk_dims=chunk_dims,
+                operation=operation,
+                logging_function=logging_function,
+            )
+        else:
+            logging_function(f"Reusing already opened dataset {key[0]}")
+        return cache[key]
 
-    if is_opendap_url(url):
-        path = url
-        logging_function(f"Opened dataset as an OPeNDAP url: {url}")
+    if isinstance(input, Path):
+        logging_function(f"Opening as local file: {input}")
+        path = input
     else:
-        if url.startswith("http"):
-            # Accessing the file property writes it to disk if it's a url
-            logging_function(f"Downloading dataset for url: {url}")
+        url = input.url
+        logging_function(f"Try opening DAP link {url}")
+
+        if is_opendap_url(url):
+            path = url
+            logging_function(f"Opened dataset as an OPeNDAP url: {url}")
         else:
-            logging_function(f"Opening as local file: {input.file}")
-        path = input.file
+            if url.startswith("http"):
+                # Accessing the file property writes it to disk if it's a url
+                logging_function(f"Downloading dataset for url: {url}")
+            else:
+                logging_function(f"Opening as local file: {input.file}")
+            path = input.file
 
     try:
         # Try to open the dataset
@@ -432,13 +572,181 @@ def try_opendap(
 
     # To handle large number of grid cells (50+) in subsetted data
     if "region" in ds.dims and "time" in ds.dims:
-        chunks = dict(time=-1, region=5)
-        ds = ds.chunk(chunks)
-    elif chunks is None or chunk_dims is not None:
-        ds = ds.chunk(chunk_dataset(ds, max_size=1000000, chunk_dims=chunk_dims))
+        ds = ds.chunk(chunk_regions(ds))
+    elif chunks is None or chunk_dims is not None or operation is not None:
+        ds = ds.chunk(chunk_dataset(ds, chunk_dims=chunk_dims, operation=operation))
     return ds
 
 
+def _dataset_key(input: ComplexInput | Path) -> str:
+    """Return the url of a remote input, or the resolved path of a local one."""
+    if isinstance(input, Path):
+        return str(input.resolve())
+    if input.prop == "url" and not input.url.startswith("file://"):
+        return input.url
+    return str(Path(input.file).resolve())
+
+
+@contextmanager
+def opened_datasets() -> Generator[dict[tuple, xr.Dataset], None, None]:
+    """Provide a cache of opened datasets, to be passed to :py:func:`try_opendap`.
+
+    All datasets are closed on exit, so file handles don't leak in long-lived workers.
+    """
+    cache = {}
+    try:
+        yield cache
+    finally:
+        for ds in cache.values():
+            ds.close()
+
+
+def get_cache_dir(kind: str) -> Path | None:
+    """Return the directory where finch keeps files of a given kind across requests.
+
+    Returns None when no `cache_dir` is configured, in which case caching is disabled.
+    """
+    root = get_config_value("finch", "cache_dir")
+    if not root:
+        return None
+    path = Path(root) / kind
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def file_digest(path: Path, block_size: int = 2**20) -> str:
+    """Return the sha256 digest of the content of a file, read block by block."""
+    h = sha256()
+    with Path(path).open("rb") as f:
+        while block := f.read(block_size):
+            h.update(block)
+    return h.hexdigest()
+
+
+def download(url: str, path: Path, chunk_size: int = 2**20) -> Path:
+    """Download a file over HTTP, resuming a previous partial download if there is one.
+
+    Data is written to a ".part" file specific to this server process, which replaces
+    `path` once the download is complete. The `maxsingleinputsize` limit of the server
+    configuration is enforced.
+    """
+    max_size = get_config_value("server", "maxsingleinputsize")
+    max_size = configuration.get_size_mb(max_size) * 1024**2 if max_size else 0
+    part = path.with_name(f"{path.name}.{os.getpid()}.part")
+    headers = {}
+    if part.exists():
+        headers["Range"] = f"bytes={part.stat().st_size}-"
+
+    with get_http_session().get(
+        url, headers=headers, stream=True, timeout=30
+    ) as response:
+        response.raise_for_status()
+        # The server might not support ranges, in which case we start over.
+        resume = response.status_code == 206
+        size = part.stat().st_size if resume else 0
+        with part.open("ab" if resume else "wb") as f:
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                size += len(chunk)
+                if 0 < max_size < size:
+                    raise FileSizeExceeded(
+                        f"File size for {url} exceeded. Maximum allowed: {max_size} bytes."
+                    )
+                f.write(chunk)
+
+    part.replace(path)
+    return path
+
+
+def prune_cache(directory: Path, pattern: str, max_files: int) -> None:
+    """Remove the least recently used files of a cache directory, keeping `max_files`.
+
+    Directories emptied by the removal of their files are removed as well.
+    """
+    files = []
+    for f in directory.glob(pattern):
+        # Files may be removed at the same time by another server process
+        with suppress(FileNotFoundError):
+            files.append((f.stat().st_mtime, f))
+    files.sort()
+    for _, f in files[:-max_files]:
+        f.unlink(missing_ok=True)
+        if f.parent != directory:
+            with suppress(OSError):
+                f.parent.rmdir()
+
+
+# Downloads of the same file by concurrent requests are done one at a time
+_download_locks: dict[Path, Lock] = {}
+_download_locks_lock = Lock()
+
+
+def _download_cached(url: str, target: Path) -> None:
+    with _download_locks_lock:
+        lock = _download_locks.setdefault(target, Lock())
+    with lock:
+        if target.exists():
+            # Mark as recently used
+            target.touch()
+            return
+        target.parent.mkdir(parents=True, exist_ok=True)
+        download(url, target)
+    prune_cache(target.parent.parent, "*/*", MAX_DOWNLOADS)
+
+
+def prefetch_inputs(process: Process, inputs: Iterable[ComplexInput]) -> None:
+    """Download all the plain HTTP inputs concurrently, before computations start.
+
+    OPeNDAP urls and local files are left untouched. Inputs pointing to the same url are
+    downloaded once. The number of simultaneous downloads is given by the
+    `download_threads` configuration value.
+
+    When a `cache_dir` is configured, downloads are kept in a local cache keyed by the
+    checksum of their url and shared between requests, up to `MAX_DOWNLOADS` files.
+    Interrupted downloads are resumed. Otherwise, files are downloaded in the working
+    directory of the inputs.
+    """
+    to_fetch: dict[str, list[ComplexInput]] = {}
+    for inp in inputs:
+        if (
+            isinstance(inp, ComplexInput)
+            and inp.prop == "url"
+            and inp.url.startswith("http")
+            and not is_opendap_url(inp.url)
+        ):
+            to_fetch.setdefault(inp.url, []).append(inp)
+    if not to_fetch:
+        return
+
+    cache = get_cache_dir("downloads")
+    n_files = len(to_fetch)
+    count = 0
+    lock = Lock()
+
+    def _fetch(url: str):
+        nonlocal count
+        first = to_fetch[url][0]
+        # One directory per url, so that urls sharing a file name get distinct files
+        name = Path(urlparse(url).path).name or f"{first.identifier}.nc"
+        subdir = sha256(url.encode()).hexdigest()[:16]
+        if cache is None:
+            path = Path(first.workdir) / subdir / name
+            path.parent.mkdir(parents=True, exist_ok=True)
+            download(url, path)
+        else:
+            path = cache / subdir / name
+            _download_cached(url, path)
+        for inp in to_fetch[url]:
+            inp.file = str(path)
+
+        with lock:
+            count += 1
+            write_log(process, f"Downloaded file {count} of {n_files} ({url})")
+
+    threads = int(get_config_value("finch", "download_threads") or 4)
+    with ThreadPool(processes=min(threads, n_files)) as pool:
+        pool.map(_fetch, list(to_fetch))
+
+
 def process_threaded(function: Callable, inputs: Iterable):
     """Based on the current configuration, process a list threaded or not."""
     threads = int(configuration.get_config_value("finch", "subset_threads"))
@@ -453,39 +761,171 @@ def process_threaded(function: Callable, inputs: Iterable):
     return outputs
 
 
-def chunk_dataset(ds, max_size=1000000, chunk_dims=None):
-    """Ensure the chunked size of a xarray.Dataset is below a certain size.
+# Names of the spatial dimensions, kept whole by "space" operations.
+SPATIAL_DIMS = ["lat", "lon", "rlat", "rlon", "x", "y", "site", "region"]
+
+
+def _source_chunks(ds: xr.Dataset) -> dict[str, int]:
+    """Return the chunking of the largest variable of a dataset, as stored on disk.
+
+    Chunk sizes are taken from the netCDF encoding, or from the `_ChunkSizes` attribute
+    added by OPeNDAP servers.
+    """
+    if not ds.data_vars:
+        return {}
+    var = max(ds.data_vars.values(), key=lambda v: v.size)
+    sizes = var.encoding.get("chunksizes") or var.attrs.get("_ChunkSizes")
+    if sizes is None or var.encoding.get("contiguous", False):
+        return {}
+    sizes = np.atleast_1d(sizes)
+    if len(sizes) != len(var.dims):
+        return {}
+    return {dim: int(size) for dim, size in zip(var.dims, sizes)}
+
+
+def chunk_dataset(
+    ds: xr.Dataset,
+    max_size: int | None = None,
+    chunk_dims: Iterable[str] | None = None,
+    *,
+    max_bytes: int | str | None = None,
+    operation: str | None = None,
+) -> dict[str, int]:
+    """Plan the chunking of a dataset so that chunks fit in a memory budget.
+
+    The budget is `max_bytes` (defaults to dask's `array.chunk-size` configuration), divided
+    by the largest item size of the data variables, or `max_size` elements if given.
+    Chunk sizes along each dimension are multiples of the chunking of the file on disk,
+    whenever possible, so that each on-disk chunk is read only once.
+
+    The dimensions that are chunked depend on the operation to be performed:
+
+     - "time": Computations along the time dimension (indicators, bias-adjustment).
+       The time dimension is kept whole.
+     - "space": Computations over space (spatial averages).
+       The spatial dimensions are kept whole.
+     - None: All dimensions can be chunked.
 
-    Cycle through the dimensions, divide the chunk size by 2 until criteria is met.
     If chunk_dims is given, limits the chunking to those dimensions, if they are
     found in the dataset.
     """
-    from functools import reduce
-    from itertools import cycle
-    from operator import mul
-
     chunks = dict(ds.sizes)
 
     dims = set(ds.dims).intersection(chunk_dims or ds.dims)
+    if operation == "time":
+        dims.discard("time")
+    elif operation == "space":
+        dims.difference_update(SPATIAL_DIMS)
+    elif operation is not None:
+        raise ValueError(f"Unknown operation kind for chunking: {operation}")
+
     if not dims:
         msg = (
-            f"Provided dimension names for chunking ({chunk_dims}) were "
-            f"not found in dataset dims ({ds.dims}). No chunking was done."
+            f"Provided dimension names for chunking ({chunk_dims}, operation: {operation}) "
+            f"were not found in dataset dims ({ds.dims}). No chunking was done."
         )
         LOGGER.warning(msg)
         return chunks
 
+    if max_size is None:
+        max_size = _max_chunk_elements(ds, max_bytes)
+
+    source = _source_chunks(ds)
+
     def chunk_size():
-        return reduce(mul, chunks.values())
+        return reduce(mul, chunks.values(), 1)
 
-    for dim in cycle(dims):
-        if chunk_size() < max_size:
+    while chunk_size() > max_size:
+        # Reduce the largest chunk first
+        dim = max(dims, key=lambda d: chunks[d])
+        current = chunks[dim]
+        if current == 1:
             break
-        chunks[dim] = max(chunks[dim] // 2, 1)
+        step = source.get(dim, 1)
+        if current > step > 1:
+            # Stay aligned with the chunks on disk
+            chunks[dim] = max(current // 2 // step * step, step)
+        else:
+            chunks[dim] = max(current // 2, 1)
 
     return chunks
 
 
+def _max_chunk_elements(ds: xr.Dataset, max_bytes: int | str | None = None) -> int:
+    """Return the number of elements of the largest data type of `ds` that fit in `max_bytes`."""
+    max_bytes = dask.utils.parse_bytes(max_bytes or dask.config.get("array.chunk-size"))
+    itemsize = max(
+        (v.dtype.itemsize for v in ds.data_vars.values() if v.dtype != object),
+        default=8,
+    )
+    return max(max_bytes // itemsize, 1)
+
+
+def chunk_regions(
+    ds: xr.Dataset,
+    max_bytes: int | str | None = None,
+    workers: int | None = None,
+    single_block: bool = True,
+) -> dict[str, int]:
+    """Plan the chunking of a dataset of time series over a "region" dimension.
+
+    The time dimension is kept whole. If all regions fit in a single chunk of `max_bytes`
+    (defaults to dask's `array.chunk-size`) and `single_block` is True, they are computed
+    as one vectorized block. Otherwise, regions are split evenly between the `workers`
+    (defaults to the number of workers of dask's scheduler), in chunks that fit the budget.
+    """
+    n_regions = ds.sizes["region"]
+    per_region = reduce(mul, (n for d, n in ds.sizes.items() if d != "region"), 1)
+    by_budget = max(_max_chunk_elements(ds, max_bytes) // per_region, 1)
+
+    if single_block and by_budget >= n_regions:
+        size = n_regions
+    else:
+        workers = workers or dask.config.get("num_workers", None) or CPU_COUNT
+        size = min(by_budget, -(-n_regions // workers))
+
+    return {"time": -1, "region": size}
+
+
+def chunk_time_series(
+    ds: xr.Dataset | xr.DataArray,
+    window: int = 1,
+    max_bytes: int | str | None = None,
+    workers: int | None = None,
+) -> dict[str, int]:
+    """Plan the chunking of gridded time series for computations over the whole time axis.
+
+    The time dimension is kept whole and the other dimensions are split so that a chunk,
+    once expanded by a rolling `window` (as done by grouped bias-adjustment), fits in
+    `max_bytes` (defaults to dask's `array.chunk-size`). Chunks are split further until
+    there are at least as many as `workers` (defaults to the number of workers of
+    dask's scheduler), when possible.
+    """
+    if isinstance(ds, xr.DataArray):
+        ds = ds.to_dataset(name=ds.name or "data")
+
+    dims = [d for d in ds.dims if d != "time"]
+    if not dims:
+        return {"time": -1}
+
+    max_size = max(_max_chunk_elements(ds, max_bytes) // max(window, 1), 1)
+    chunks = chunk_dataset(ds, max_size=max_size, operation="time")
+
+    workers = workers or dask.config.get("num_workers", None) or CPU_COUNT
+
+    def n_chunks():
+        return reduce(mul, (-(-ds.sizes[d] // chunks[d]) for d in dims), 1)
+
+    while n_chunks() < workers:
+        dim = max(dims, key=lambda d: chunks[d])
+        if chunks[dim] == 1:
+            break
+        chunks[dim] = -(-chunks[dim] // 2)
+
+    chunks["time"] = -1
+    return chunks
+
+
 def make_metalink_output(
     process: Process, files: list[Path], description: str | None = None
 ) -> MetaLink4:
@@ -505,6 +945,40 @@ def make_metalink_output(
     return metalink
 
 
+# Results of OPeNDAP probes, keyed by scheme, host and directory, along with their time.
+_opendap_probes: dict[tuple[str, str, str], tuple[float, bool]] = {}
+_opendap_probes_lock = Lock()
+_http_session: requests.Session | None = None
+_http_session_lock = Lock()
+
+
+def get_http_session() -> requests.Session:
+    """Return the HTTP session shared by all requests of this worker.
+
+    Connections are pooled and kept alive, so successive requests to the same host
+    don't have to establish a new connection each time.
+    """
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _http_session = session
+    return _http_session
+
+
+def _opendap_prefixes() -> list[str]:
+    """Return the OPeNDAP url prefixes of the THREDDS servers of the configured datasets."""
+    prefixes = []
+    for dsconf in get_datasets_config().values():
+        if not dsconf.local and "/thredds/catalog/" in dsconf.path:
+            root = dsconf.path.split("/thredds/catalog/")[0]
+            prefixes.append(f"{root}/thredds/dodsC/")
+    return prefixes
+
+
 def is_opendap_url(url):
     """Check if a provided url is an OpenDAP url.
 
@@ -515,24 +989,39 @@ def is_opendap_url(url):
 
     Even then, some OpenDAP servers seem to not include the specified header...
     So we need to let the netCDF4 library actually open the file.
+
+    Urls served by the THREDDS servers of the configured datasets are recognized without any request.
+    Otherwise, the result of the probe is cached for all urls of the same host and directory,
+    for `opendap_probe_ttl` seconds (see the `finch` configuration section).
     """
     parts = urlparse(url)
-    meta_url = urlunparse([parts[0], parts[1], parts[2] + ".dds", None, None, None])
+    if parts.scheme not in ["http", "https"]:
+        return False
 
-    # TODO: Audit URL for permitted schemes
-    req = urllib.request.Request(meta_url, method="HEAD")  # noqa: S310
+    if any(url.startswith(prefix) for prefix in _opendap_prefixes()):
+        return True
 
+    key = (parts.scheme, parts.netloc, parts.path.rsplit("/", 1)[0])
+    ttl = float(get_config_value("finch", "opendap_probe_ttl") or 3600)
+    with _opendap_probes_lock:
+        probed_at, result = _opendap_probes.get(key, (None, None))
+    if probed_at is not None and time.monotonic() - probed_at < ttl:
+        return result
+
+    meta_url = urlunparse([parts[0], parts[1], parts[2] + ".dds", None, None, None])
     try:
-        # TODO: Audit URL for permitted schemes
-        with urllib.request.urlopen(req, timeout=5) as response:  # noqa: S310
-            content_description = response.headers.get("Content-Description")
-    except URLError:
+        response = get_http_session().head(meta_url, timeout=5, allow_redirects=True)
+    except requests.RequestException:
+        # Network errors are not cached, the server might only be temporarily unavailable.
         return False
 
-    if content_description:
-        return content_description.lower().startswith("dods")
-    else:
-        return False
+    content_description = response.headers.get("Content-Description")
+    result = bool(content_description) and content_description.lower().startswith(
+        "dods"
+    )
+    with _opendap_probes_lock:
+        _opendap_probes[key] = (time.monotonic(), result)
+    return result
 
 
 def single_input_or_none(inputs, identifier) -> Any | None:
@@ -749,16 +1238,22 @@ def make_tasmin_tasmax_pairs(
     filenames: list[Path],
 ) -> Generator[tuple[Path, Path], None, None]:
     """Return pairs of corresponding tasmin-tasmax files based on their filename."""
-    tasmin_files = [f for f in filenames if "tasmin" in f.name.lower()]
-    tasmax_files = [f for f in filenames if "tasmax" in f.name.lower()]
-    for tasmin in tasmin_files[:]:
-        for tasmax in tasmax_files[:]:
-            if tasmin.name.lower() == tasmax.name.lower().replace("tasmax", "tasmin"):
-                yield tasmin, tasmax
-                tasmax_files.remove(tasmax)
-                tasmin_files.remove(tasmin)
-                break
-    for f in tasmax_files + tasmax_files:
+    tasmax_files = {}
+    for f in filenames:
+        name = f.name.lower()
+        if "tasmax" in name:
+            tasmax_files.setdefault(name.replace("tasmax", "tasmin"), f)
+
+    unmatched = []
+    for f in filenames:
+        name = f.name.lower()
+        if "tasmin" in name and "tasmax" not in name:
+            tasmax = tasmax_files.pop(name, None)
+            if tasmax is None:
+                unmatched.append(f)
+            else:
+                yield f, tasmax
+    for f in unmatched + list(tasmax_files.values()):
         sentry_sdk.capture_message(
             f"Couldn't find matching tasmin or tasmax for: {f}", level="error"
         )
@@ -801,9 +1296,19 @@ def fix_broken_time_index(ds: xr.Dataset):
 
 
 def dataset_to_netcdf(
-    ds: xr.Dataset, output_path: Path | str, compression_level=0
+    ds: xr.Dataset,
+    output_path: Path | str,
+    compression_level=0,
+    stream=False,
+    client: Client | None = None,
 ) -> None:
-    """Write an :py:class:`xarray.Dataset` dataset to disk, optionally using compression."""
+    """Write an :py:class:`xarray.Dataset` dataset to disk, optionally using compression.
+
+    With `stream`, dask-backed data larger than a quarter of the memory is computed and
+    written chunk by chunk, so that outputs larger than memory can be written. Smaller
+    outputs are computed at once, on the default scheduler. Computations are done on the
+    workers of a dask distributed `client` when one is given.
+    """
     encoding = {}
 
     if "time" in ds.dims:
@@ -815,7 +1320,27 @@ def dataset_to_netcdf(
         for v in ds.data_vars:
             encoding[v] = {"zlib": True, "complevel": compression_level}
 
+    if stream and ds.nbytes > MEMORY_LIMIT // 4:
+        if client is not None:
+            # With the client as current, xarray has the workers write the chunks
+            # they compute, with distributed locks.
+            with client.as_current():
+                delayed = ds.to_netcdf(
+                    str(output_path), format="NETCDF4", encoding=encoding, compute=False
+                )
+                client.compute(delayed).result()
+            return
+        # Chunks are computed and written one after the other, in this thread, which
+        # avoids the lock-ups below without loading everything first.
+        delayed = ds.to_netcdf(
+            str(output_path), format="NETCDF4", encoding=encoding, compute=False
+        )
+        delayed.compute(scheduler="synchronous")
+        return
+
     # Perform computations
+    if client is not None:
+        ds = client.compute(ds).result()
     ds.load()
 
     # This is necessary when running with gunicorn to avoid lock-ups
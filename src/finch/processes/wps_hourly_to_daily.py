@@ -1,8 +1,11 @@
 # noqa: D100
 import json
 import logging
+from collections.abc import Sequence
 from pathlib import Path
 
+import numpy as np
+import pandas as pd
 import xarray as xr
 from pywps import FORMATS, ComplexInput, ComplexOutput
 from xclim.core.options import MISSING_METHODS
@@ -46,7 +49,7 @@ class HourlyToDailyProcess(FinchProcess):
             ComplexOutput(
                 "output",
                 "Daily statistic in netCDF",
-                abstract="The daily statistic computed from hourly data.",
+                abstract="The daily statistics computed from hourly data.",
                 as_reference=True,
                 supported_formats=[FORMATS.NETCDF],
             ),
@@ -58,7 +61,9 @@ class HourlyToDailyProcess(FinchProcess):
             identifier="hourly_to_daily",
             version="0.1",
             title="Resample from hourly frequency to daily frequency.",
-            abstract="Take the mean, sum, minimum or maximum of hourly data over each day to compute daily values.",
+            abstract="Take the mean, sum, minimum or maximum of hourly data over each day to compute daily values. "
+            "Multiple statistics can be computed at once, in which case the output variables are suffixed "
+            "with the name of the statistic (ex: `tas_max`).",
             inputs=inputs,
             outputs=outputs,
             status_supported=True,
@@ -76,7 +81,7 @@ class HourlyToDailyProcess(FinchProcess):
         # --- Process inputs ---
         resource = request.inputs["resource"][0]
         variables = [r.data for r in request.inputs.get("variable", [])]
-        reducer = request.inputs["reducer"][0].data
+        reducer = [r.data for r in request.inputs["reducer"]]
         check_missing = request.inputs["check_missing"][0].data
         missing_options = json.loads(request.inputs["missing_options"][0].data)
 
@@ -104,37 +109,108 @@ class HourlyToDailyProcess(FinchProcess):
         response.outputs["output_log"].file = str(log_file_path(self))
 
 
+# Missing values checks that only depend on the number of valid hours of each day,
+# functions of that number and of the options of the xclim method of the same name.
+_valid_hours_checks = {
+    "any": lambda valid: valid < 24,
+    "pct": lambda valid, tolerance=0.1: (24 - valid) / 24 >= tolerance,
+    "at_least_n": lambda valid, n=20: valid < n,
+}
+
+
+def _daily_blocks(ds: xr.Dataset) -> xr.Dataset | None:
+    """Reshape regular hourly time series into blocks of (time, hour), without copying them.
+
+    The first and last days are completed with missing values, and days are labelled
+    like with `resample`. Returns None if the time axis is not regular hourly.
+    """
+    time = ds.indexes["time"]
+    if (
+        not isinstance(time, pd.DatetimeIndex)
+        or time.size < 2
+        or not (np.diff(time.values) == np.timedelta64(1, "h")).all()
+    ):
+        return None
+
+    lead = time[0].hour
+    trail = -(lead + time.size) % 24
+    days = pd.date_range(
+        time[0].normalize(), periods=(lead + time.size + trail) // 24, freq="D"
+    )
+
+    blocks = ds.drop_vars([name for name, c in ds.coords.items() if "time" in c.dims])
+    if lead or trail:
+        blocks = blocks.pad(time=(lead, trail))
+    blocks = blocks.coarsen(time=24).construct(time=("day", "hour"))
+    return blocks.rename(day="time").assign_coords(time=days)
+
+
 def _hourly_to_daily(
-    ds: xr.Dataset, reducer: str, check_missing: str, missing_options: dict
+    ds: xr.Dataset,
+    reducer: str | Sequence[str],
+    check_missing: str,
+    missing_options: dict,
 ) -> xr.Dataset:
-    """Convert an hourly time series to a daily time series."""
+    """Convert an hourly time series to a daily time series.
+
+    Regular hourly series are reshaped into days of 24 hours, so that the daily
+    statistics and the number of valid hours are computed in a single pass over the data.
+    Other time axes, and missing values methods that don't only depend on the number of
+    valid hours, use xarray's `resample` and xclim's missing values checks.
+
+    With multiple reducers, the output variables are named `{variable}_{reducer}`.
+    """
+    reducers = [reducer] if isinstance(reducer, str) else list(dict.fromkeys(reducer))
+
     # Validate missing values algorithm options
     kls = MISSING_METHODS[check_missing]
     missing = kls.execute
     if missing_options:
         kls.validate(**missing_options)
 
-    # Resample to daily
-    out = getattr(ds.resample(time="D"), reducer)(keep_attrs=True)
+    blocks = None
+    if check_missing == "skip" or check_missing in _valid_hours_checks:
+        blocks = _daily_blocks(ds)
 
-    # Update and format attributes
-    for key, da in out.data_vars.items():
-        # Update cell_methods
-        da.attrs["cell_methods"] = (
-            da.attrs.get("cell_methods", " ") + f" time: {reducer} within days"
-        ).strip()
-
-        # Update history
-        da.attrs["history"] = update_history(
-            f"Reduce hourly data to daily using {reducer}.", da
-        )
-
-    # Compute missing values mask
+    # Compute missing values masks, shared by all reducers
+    masks = {}
     if check_missing != "skip":
         for key, da in ds.data_vars.items():
-            mask = missing(
-                da, freq="D", src_timestep="H", options=missing_options, indexer={}
+            if blocks is not None:
+                valid = blocks[key].count("hour")
+                masks[key] = _valid_hours_checks[check_missing](
+                    valid, **missing_options
+                )
+            else:
+                masks[key] = missing(
+                    da, freq="D", src_timestep="H", options=missing_options, indexer={}
+                )
+
+    outs = []
+    for red in reducers:
+        # Resample to daily
+        if blocks is not None:
+            out = getattr(blocks, red)("hour", keep_attrs=True)
+        else:
+            out = getattr(ds.resample(time="D"), red)(keep_attrs=True)
+
+        # Update and format attributes
+        for key, da in out.data_vars.items():
+            # Update cell_methods
+            da.attrs["cell_methods"] = (
+                da.attrs.get("cell_methods", " ") + f" time: {red} within days"
+            ).strip()
+
+            # Update history
+            da.attrs["history"] = update_history(
+                f"Reduce hourly data to daily using {red}.", da
             )
+
+        for key, mask in masks.items():
             out[key] = out[key].where(~mask)
 
-    return out
+        if len(reducers) > 1:
+            out = out.rename({key: f"{key}_{red}" for key in out.data_vars})
+        outs.append(out)
+
+    return xr.merge(outs, combine_attrs="override")
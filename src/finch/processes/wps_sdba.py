@@ -3,24 +3,48 @@
 Statistical downscaling and bias adjustment
 ===========================================
 
-Expose xclim.sdba algorithms as WPS.
+Expose xclim.sdba algorithms as WPS: empirical, detrended and delta quantile mapping.
 
-For the moment, both train-adjust operations are bundled into a single process.
+Training and adjustment are done in a single request, or separately with the `mode`
+input, in which case trained adjustments can be reused for many simulations.
 """
 
+import atexit
 import logging
+import os
+import shutil
+import time
+from hashlib import sha256
 from pathlib import Path
+from threading import Lock
 
+import cftime
+import numpy as np
+import xarray as xr
 import xclim
 from pywps import FORMATS, ComplexInput, ComplexOutput, LiteralInput
+from pywps.app.exceptions import ProcessError
+from pywps.configuration import get_config_value
 from xclim.core.calendar import convert_calendar
+from xclim.sdba import (
+    DetrendedQuantileMapping,
+    EmpiricalQuantileMapping,
+    QuantileDeltaMapping,
+)
+from xclim.sdba.adjustment import TrainAdjust
 from xclim.sdba.utils import ADDITIVE, MULTIPLICATIVE
 
 from . import wpsio
 from .utils import (
+    chunk_time_series,
     dataset_to_netcdf,
+    file_digest,
+    get_cache_dir,
+    is_opendap_url,
     log_file_path,
     make_metalink_output,
+    prefetch_inputs,
+    prune_cache,
     single_input_or_none,
     try_opendap,
     valid_filename,
@@ -30,6 +54,43 @@ from .wps_base import FinchProcess, FinchProgressBar
 
 LOGGER = logging.getLogger("PYWPS")
 
+# Number of trained adjustments kept in the "sdba" cache
+MAX_TRAINED = 1000
+
+# Client of the local dask cluster shared by the bias-adjustment requests
+_client = None
+_client_lock = Lock()
+
+
+def get_sdba_client():
+    """Return a client of the local dask cluster used for bias-adjustment, if configured.
+
+    The cluster is started on first use with `sdba_workers` worker processes and shared
+    by all requests handled by this server process. Returns None when `sdba_workers` is
+    0 (the default), in which case computations run on dask's default scheduler.
+    """
+    global _client
+
+    workers = int(get_config_value("finch", "sdba_workers") or 0)
+    if workers < 1:
+        return None
+
+    with _client_lock:
+        if _client is None:
+            from dask.distributed import Client, LocalCluster
+
+            cluster = LocalCluster(
+                n_workers=workers,
+                threads_per_worker=1,
+                processes=True,
+                dashboard_address=None,
+            )
+            _client = Client(cluster, set_as_default=False)
+            atexit.register(cluster.close)
+            atexit.register(_client.close)
+    return _client
+
+
 group_args = dict(
     group=LiteralInput(
         "group",
@@ -71,34 +132,89 @@ adjust_args = dict(
     ),
 )
 
+train_args = dict(
+    nquantiles=LiteralInput(
+        "nquantiles",
+        "Number of quantile bins",
+        abstract="The number of quantiles to use. Two endpoints at 1e-6 and 1 - 1e-6 will be added.",
+        data_type="integer",
+        default=20,
+        min_occurs=0,
+    ),
+    kind=LiteralInput(
+        "kind",
+        "Kind of adjustment (+, *)",
+        abstract="Use * for multiplicative adjustment, or + for additive adjustement.",
+        data_type="string",
+        default=ADDITIVE,
+        allowed_values=[ADDITIVE, MULTIPLICATIVE],
+        min_occurs=0,
+    ),
+)
+
 resources = dict(
     ref=ComplexInput(
         "ref",
         "Reference dataset",
-        abstract="Reference netCDF resource, typically observations or reanalyses.",
+        abstract="Reference netCDF resource, typically observations or reanalyses. "
+        "Required unless `mode` is `adjust`.",
+        min_occurs=0,
         max_occurs=1,
         supported_formats=[FORMATS.NETCDF, FORMATS.DODS],
     ),
     hist=ComplexInput(
         "hist",
         "Historical simulation",
-        abstract="Historical simulation netCDF resource overlapping the reference dataset.",
+        abstract="Historical simulation netCDF resource overlapping the reference dataset. "
+        "Required unless `mode` is `adjust`.",
+        min_occurs=0,
         max_occurs=1,
         supported_formats=[FORMATS.NETCDF, FORMATS.DODS],
     ),
     sim=ComplexInput(
         "sim",
         "Target simulation to be corrected",
-        abstract="Simulation netCDF resource whose bias will be corrected",
+        abstract="Simulation netCDF resource whose bias will be corrected. "
+        "Required unless `mode` is `train`.",
+        min_occurs=0,
         max_occurs=1,
         supported_formats=[FORMATS.NETCDF, FORMATS.DODS],
     ),
+    trained=ComplexInput(
+        "trained",
+        "Trained adjustment",
+        abstract="Output of a request in `train` mode. Required when `mode` is `adjust`.",
+        min_occurs=0,
+        max_occurs=1,
+        supported_formats=[FORMATS.NETCDF],
+    ),
+)
+
+mode_input = LiteralInput(
+    "mode",
+    "Operation mode",
+    abstract="With `train_adjust`, the adjustment is trained on `ref` and `hist`, then applied "
+    "to `sim`. With `train`, only the trained adjustment is computed and returned. It can then "
+    "be given as `trained` to requests in `adjust` mode, to correct many simulations without "
+    "training again.",
+    data_type="string",
+    default="train_adjust",
+    allowed_values=["train_adjust", "train", "adjust"],
+    min_occurs=0,
 )
 
+# Inputs needed by each mode
+mode_resources = {
+    "train_adjust": ["ref", "hist", "sim"],
+    "train": ["ref", "hist"],
+    "adjust": ["sim", "trained"],
+}
+
 common_outputs = [
     ComplexOutput(
         "output",
         "netCDF output",
+        abstract="The bias-adjusted simulation, or the trained adjustment in `train` mode.",
         as_reference=True,
         supported_formats=[FORMATS.NETCDF],
     ),
@@ -107,44 +223,115 @@ common_outputs = [
 ]
 
 
-class EmpiricalQuantileMappingProcess(FinchProcess):
-    """Calculate Empirical Quantile Mapping bias-adjustment."""
+def _input_key(input: ComplexInput) -> str:
+    """Identify an input by its OPeNDAP url, or by the digest of its content."""
+    if input.prop == "url" and is_opendap_url(input.url):
+        return input.url
+    return file_digest(Path(input.file))
+
+
+def trained_cache_path(
+    method: str, variable: str, ref: ComplexInput, hist: ComplexInput, params: dict
+) -> Path | None:
+    """Return the path of a trained adjustment in the persistent cache.
+
+    The key is made of the adjustment method, the variable, the `ref` and `hist` inputs
+    and the training parameters. Returns None when caching is disabled.
+    """
+    cache = get_cache_dir("sdba")
+    if cache is None:
+        return None
+    key = repr(
+        (
+            method,
+            variable,
+            _input_key(ref),
+            _input_key(hist),
+            sorted(params.items()),
+            xclim.__version__,
+        )
+    )
+    return cache / f"{sha256(key.encode()).hexdigest()[:32]}.nc"
+
+
+def align_noleap(da: xr.DataArray) -> xr.DataArray:
+    """Align a series on the `noleap` calendar without copying its data.
+
+    February 29th is dropped by index selection, which keeps the chunks of the other
+    dimensions, and the time coordinate is replaced by its `noleap` equivalent. Series
+    already in a 365-day calendar are returned as is. Conversions from a 360-day
+    calendar, which need the days of the year to be realigned, use xclim, with the
+    days spread evenly over the year (`align_on="year"`).
+    """
+    calendar = da.time.dt.calendar
+    if calendar in ["noleap", "365_day"]:
+        return da
+    if calendar == "360_day":
+        return convert_calendar(da, "noleap", align_on="year")
+
+    leap = ((da.time.dt.month == 2) & (da.time.dt.day == 29)).values
+    if leap.any():
+        da = da.isel(time=np.flatnonzero(~leap))
+
+    attrs = {k: v for k, v in da.time.attrs.items() if k != "calendar"}
+    times = xr.CFTimeIndex(
+        [
+            cftime.DatetimeNoLeap(
+                t.year, t.month, t.day, t.hour, t.minute, t.second, t.microsecond
+            )
+            for t in da.indexes["time"]
+        ]
+    )
+    return da.assign_coords(time=xr.DataArray(times, dims="time", attrs=attrs))
+
+
+def load_trained(input: ComplexInput, method: type[TrainAdjust]) -> TrainAdjust:
+    """Read a trained adjustment of the given method, as output in `train` mode."""
+    try:
+        bc = method.from_dataset(try_opendap(input))
+    except KeyError as err:
+        # The attribute holding the serialized adjustment is missing
+        raise ProcessError("The `trained` input is not a trained adjustment.") from err
+    if not isinstance(bc, method):
+        raise ProcessError(
+            f"The `trained` input is a {type(bc).__name__} adjustment, "
+            f"not a {method.__name__} one."
+        )
+    return bc
+
+
+class BiasAdjustmentBase(FinchProcess):
+    """Bias-adjustment process base class.
+
+    Set `method` to the xclim.sdba adjustment class, and `train_args` and `adjust_args`
+    to the inputs of its `train` and `adjust` methods. Loading and chunking the inputs,
+    caching trained adjustments and writing the outputs are shared by all methods.
+    """
+
+    method: type[TrainAdjust] | None = None
+    train_args = train_args
+    adjust_args = adjust_args
+
+    def __init__(self, identifier: str, title: str, abstract: str):
+        if self.method is None:
+            raise AttributeError("Set `method` to an xclim.sdba adjustment class.")
 
-    def __init__(self):
         inputs = (
-            list(resources.values())
+            [mode_input]
+            + list(resources.values())
             + list(group_args.values())
-            + list(adjust_args.values())
-            + [
-                wpsio.variable_any,
-                LiteralInput(
-                    "nquantiles",
-                    "Number of quantile bins",
-                    abstract="The number of quantiles to use. Two endpoints at 1e-6 and 1 - 1e-6 will be added.",
-                    data_type="integer",
-                    default=20,
-                    min_occurs=0,
-                ),
-                LiteralInput(
-                    "kind",
-                    "Kind of adjustment (+, *)",
-                    abstract="Use * for multiplicative adjustment, or + for additive adjustement.",
-                    data_type="string",
-                    default=ADDITIVE,
-                    allowed_values=[ADDITIVE, MULTIPLICATIVE],
-                    min_occurs=0,
-                ),
-                wpsio.output_name,
-            ]
+            + list(self.adjust_args.values())
+            + [wpsio.variable_any]
+            + list(self.train_args.values())
+            + [wpsio.output_name]
         )
 
         super().__init__(
             self._handler,
-            identifier="empirical_quantile_mapping",
-            title="Empirical Quantile Mapping bias-adjustment",
+            identifier=identifier,
+            title=title,
             version="0.1",
-            abstract="Adjustment factors are computed between the quantiles of `ref` and `sim`."
-            "Values of `sim` are matched to the corresponding quantiles of `hist` and corrected accordingly.",
+            abstract=abstract,
             inputs=inputs,
             outputs=common_outputs,
             status_supported=True,
@@ -155,56 +342,123 @@ class EmpiricalQuantileMappingProcess(FinchProcess):
         def _log(message, percentage):
             write_log(self, message, subtask_percentage=percentage)
 
-        res = {}
-        group = {}
-        train = {}
-        adj = {}
-
-        variable = request.inputs.pop(wpsio.variable_any.identifier, None)
+        mode = single_input_or_none(request.inputs, "mode") or "train_adjust"
+        keys = mode_resources[mode]
+        missing = [key for key in keys if key not in request.inputs]
+        if missing:
+            raise ProcessError(
+                f"Inputs {', '.join(missing)} are required in {mode} mode."
+            )
 
-        for key in request.inputs.keys():
-            if key in resources:
-                ds = try_opendap(request.inputs[key][0])
-                name = variable or list(ds.data_vars)[0]
+        def _args(inputs):
+            return {
+                key: single_input_or_none(request.inputs, key)
+                for key in inputs
+                if key in request.inputs
+            }
 
-                # Force calendar to noleap and rechunk
-                res[key] = convert_calendar(ds[name], "noleap").chunk({"time": -1})
+        variable = single_input_or_none(request.inputs, wpsio.variable_any.identifier)
+        group = _args(group_args)
+        train = _args(self.train_args)
+        adj = _args(self.adjust_args)
 
-            elif key in group_args:
-                group[key] = single_input_or_none(request.inputs, key)
+        prefetch_inputs(self, [request.inputs[key][0] for key in keys])
 
-            elif key in adjust_args:
-                adj[key] = single_input_or_none(request.inputs, key)
+        # Cells are adjusted independently, in spatial chunks holding the whole series
+        client = get_sdba_client()
+        workers = len(client.scheduler_info()["workers"]) if client else None
+        window = group.get("window") or 1
 
-            else:
-                train[key] = single_input_or_none(request.inputs, key)
+        res = {}
+        for key in keys:
+            if key in ["ref", "hist", "sim"]:
+                ds = try_opendap(request.inputs[key][0], chunks=False)
+                name = variable or list(ds.data_vars)[0]
+                da = ds[name]
+                da = da.chunk(chunk_time_series(da, window=window, workers=workers))
+                res[key] = align_noleap(da)
 
         _log("Successfully read inputs from request.", 1)
 
-        group = xclim.sdba.Grouper(**group)
-        _log("Grouper object created.", 2)
+        def _write(ds, path, start_percentage, end_percentage):
+            # Outputs that may not fit in memory are computed and written chunk by chunk
+            if client is None:
+                with FinchProgressBar(
+                    logging_function=_log,
+                    start_percentage=start_percentage,
+                    end_percentage=end_percentage,
+                    width=15,
+                    dt=1,
+                ):
+                    dataset_to_netcdf(ds, path, stream=True)
+            else:
+                _log(
+                    f"Computing on the local dask cluster ({workers} workers).",
+                    start_percentage,
+                )
+                dataset_to_netcdf(ds, path, stream=True, client=client)
 
-        bc = xclim.sdba.EmpiricalQuantileMapping.train(
-            res["ref"], res["hist"], **train, group=group
+        filename = valid_filename(
+            single_input_or_none(request.inputs, "output_name")
+            or ("trained_adjustment" if mode == "train" else "bias_corrected")
         )
+        out_fn = Path(self.workdir) / f"{filename}.nc"
+        start = time.perf_counter()
 
-        _log("Training object created.", 3)
+        cached = None
+        if mode == "adjust":
+            bc = load_trained(request.inputs["trained"][0], self.method)
+            _log("Trained adjustment read from input.", 3)
+        else:
+            cached = trained_cache_path(
+                self.method.__name__,
+                name,
+                request.inputs["ref"][0],
+                request.inputs["hist"][0],
+                {**group, **train},
+            )
+            if cached is not None and cached.exists():
+                _log("Reusing the cached trained adjustment.", 3)
+                # Mark as recently used
+                cached.touch()
+            else:
+                bc = self.method.train(
+                    res["ref"], res["hist"], **train, group=xclim.sdba.Grouper(**group)
+                )
+                _log("Training object created.", 3)
+                if cached is not None:
+                    # Write under a temporary name, so concurrent requests never read partial files
+                    tmp = cached.with_suffix(f".{os.getpid()}.tmp")
+                    _write(bc.ds, tmp, 3, 50)
+                    tmp.replace(cached)
+                    prune_cache(cached.parent, "*.nc", MAX_TRAINED)
+            if cached is not None:
+                # Trained adjustments are small, load them to release the file
+                bc = self.method.from_dataset(xr.load_dataset(cached))
 
-        out = bc.adjust(res["sim"], **adj).to_dataset(name=name)
-        _log("Adjustment object created.", 5)
+        if mode == "train":
+            if cached is not None:
+                shutil.copyfile(cached, out_fn)
+            else:
+                _write(bc.ds, out_fn, 3, 98)
+        else:
+            # Keep the dimension order of the simulation
+            out = (
+                bc.adjust(res["sim"], **adj)
+                .transpose(*res["sim"].dims)
+                .to_dataset(name=name)
+            )
+            _log("Adjustment object created.", 5)
+            _write(out, out_fn, 50 if cached is not None else 5, 98)
 
-        filename = valid_filename(
-            single_input_or_none(request.inputs, "output_name") or "bias_corrected"
+        elapsed = time.perf_counter() - start
+        series = next(iter(res.values()))
+        cells = series.size // series.sizes["time"]
+        _log(
+            f"Processed {cells} cells in {elapsed:.1f} s "
+            f"({cells / elapsed:.1f} cells/s, {workers or 'default'} workers).",
+            98,
         )
-        out_fn = Path(self.workdir) / f"{filename}.nc"
-        with FinchProgressBar(
-            logging_function=_log,
-            start_percentage=5,
-            end_percentage=98,
-            width=15,
-            dt=1,
-        ):
-            dataset_to_netcdf(out, out_fn)
 
         metalink = make_metalink_output(self, [out_fn])
 
@@ -215,3 +469,60 @@ class EmpiricalQuantileMappingProcess(FinchProcess):
         write_log(self, "Processing finished successfully", process_step="done")
 
         return response
+
+
+class EmpiricalQuantileMappingProcess(BiasAdjustmentBase):
+    """Calculate Empirical Quantile Mapping bias-adjustment."""
+
+    method = EmpiricalQuantileMapping
+
+    def __init__(self):
+        super().__init__(
+            identifier="empirical_quantile_mapping",
+            title="Empirical Quantile Mapping bias-adjustment",
+            abstract="Adjustment factors are computed between the quantiles of `ref` and `sim`."
+            "Values of `sim` are matched to the corresponding quantiles of `hist` and corrected accordingly.",
+        )
+
+
+class DetrendedQuantileMappingProcess(BiasAdjustmentBase):
+    """Calculate Detrended Quantile Mapping bias-adjustment."""
+
+    method = DetrendedQuantileMapping
+    adjust_args = dict(
+        **adjust_args,
+        detrend=LiteralInput(
+            "detrend",
+            "Detrending degree",
+            abstract="Degree of the polynomial fitted to `sim` and removed before the quantile "
+            "adjustment, then added back. 0 removes the mean only.",
+            data_type="integer",
+            default=1,
+            min_occurs=0,
+        ),
+    )
+
+    def __init__(self):
+        super().__init__(
+            identifier="detrended_quantile_mapping",
+            title="Detrended Quantile Mapping bias-adjustment",
+            abstract="Adjustment factors are computed between the quantiles of `ref` and `hist`, "
+            "after scaling `hist` to the mean of `ref`. `sim` is detrended and its values are "
+            "matched to the corresponding quantiles of `hist` and corrected accordingly, "
+            "before the trend is added back.",
+        )
+
+
+class QuantileDeltaMappingProcess(BiasAdjustmentBase):
+    """Calculate Quantile Delta Mapping bias-adjustment."""
+
+    method = QuantileDeltaMapping
+
+    def __init__(self):
+        super().__init__(
+            identifier="quantile_delta_mapping",
+            title="Quantile Delta Mapping bias-adjustment",
+            abstract="Adjustment factors are computed between the quantiles of `ref` and `hist`. "
+            "The quantile of each value of `sim` is computed within `sim` itself, and the "
+            "factor of that quantile is applied, preserving the simulated changes of all quantiles.",
+        )
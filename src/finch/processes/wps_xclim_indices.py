@@ -1,11 +1,14 @@
 # noqa: D100
 import logging
 from collections import deque
+from itertools import chain
 from pathlib import Path
 
+import dask
 import pandas as pd
 import xarray as xr
 from anyascii import anyascii
+from distributed.system import MEMORY_LIMIT
 from pandas.api.types import is_numeric_dtype  # noqa
 from pywps.app.exceptions import ProcessError
 
@@ -18,6 +21,8 @@ from .utils import (
     format_metadata,
     log_file_path,
     make_metalink_output,
+    opened_datasets,
+    prefetch_inputs,
     single_input_or_none,
     valid_filename,
     write_log,
@@ -93,45 +98,12 @@ class XclimIndicatorBase(FinchProcess):
                 f"The count of all netcdf input variables must be equal: {', '.join(nc_inputs)}."
             )
 
-        def _log(message, percentage):
-            write_log(self, message, subtask_percentage=percentage)
+        prefetch_inputs(self, chain(*nc_inputs.values()))
 
         output_name = single_input_or_none(request.inputs, "output_name")
-        output_files = []
-        input_files = [Path(fn[0].url).name for fn in nc_inputs.values()]
-
-        for n in range(n_files):
-            # create a dict containing a single netcdf input for each type
-            netcdf_inputs = {k: deque([queue[n]]) for k, queue in nc_inputs.items()}
-            inputs = {**other_inputs, **netcdf_inputs}
-
-            out = compute_indices(self, self.xci, inputs)
-            filename = _make_unique_drs_filename(
-                out,
-                [f.name for f in output_files] + input_files,
-                output_name=output_name,
-            )
-            output_filename = Path(self.workdir, filename)
-            output_files.append(output_filename)
-
-            start_percentage = int(n / n_files * 100)
-            end_percentage = int((n + 1) / n_files * 100)
-            write_log(
-                self,
-                f"Processing file {n + 1} of {n_files}",
-                subtask_percentage=start_percentage,
-            )
-
-            with FinchProgressBar(
-                logging_function=_log,
-                start_percentage=start_percentage,
-                end_percentage=end_percentage,
-                width=15,
-                dt=1,
-            ):
-                write_log(self, f"Writing file {output_filename} to disk.")
-                dataset_to_netcdf(out, output_filename)
-                out.close()
+        output_files = self._write_outputs(
+            nc_inputs, other_inputs, n_files, output_name
+        )
 
         if convert_to_csv:
             write_log(self, "Converting netCDFs to CSV", process_step="convert_to_csv")
@@ -177,6 +149,59 @@ class XclimIndicatorBase(FinchProcess):
 
         return response
 
+    def _write_outputs(
+        self,
+        nc_inputs: dict,
+        other_inputs: dict,
+        n_files: int,
+        output_name: str | None,
+    ) -> list[Path]:
+        """Compute the indicator for each set of input files and write the outputs.
+
+        Files are computed together as a single dask graph, in groups whose results fit
+        in a quarter of the memory, and written one at a time from this thread. Output
+        filenames are allocated up front, in input order, so that names don't depend
+        on the order in which files complete.
+        """
+
+        def _log(message, percentage):
+            write_log(self, message, subtask_percentage=percentage)
+
+        input_files = [Path(fn[0].url).name for fn in nc_inputs.values()]
+        # Inputs pointing to the same file share a single opened dataset.
+        with opened_datasets() as datasets:
+            groups, group_bytes = [[]], 0
+            existing_names = list(input_files)
+            for n in range(n_files):
+                # create a dict containing a single netcdf input for each type
+                netcdf_inputs = {k: deque([queue[n]]) for k, queue in nc_inputs.items()}
+                inputs = {**other_inputs, **netcdf_inputs}
+
+                out = compute_indices(self, self.xci, inputs, datasets=datasets)
+                filename = _make_unique_drs_filename(
+                    out, existing_names, output_name=output_name
+                )
+                existing_names.append(filename)
+                if groups[-1] and group_bytes + out.nbytes > MEMORY_LIMIT // 4:
+                    groups.append([])
+                    group_bytes = 0
+                groups[-1].append((out, Path(self.workdir, filename)))
+                group_bytes += out.nbytes
+
+            write_log(self, f"Computing {n_files} file(s) in {len(groups)} group(s)")
+            with FinchProgressBar(
+                logging_function=_log,
+                start_percentage=0,
+                end_percentage=100,
+                width=15,
+                dt=1,
+            ):
+                for group in groups:
+                    computed = dask.compute(*[out for out, _ in group])
+                    for out, (_, output_filename) in zip(computed, group):
+                        dataset_to_netcdf(out, output_filename)
+        return [output_filename for group in groups for _, output_filename in group]
+
 
 def _make_unique_drs_filename(
     ds: xr.Dataset, existing_names: list[str], output_name: str | None = None
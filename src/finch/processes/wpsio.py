@@ -347,11 +347,12 @@ tolerance = LiteralInput(
 reducer = LiteralInput(
     "reducer",
     "Reduction operation",
-    abstract="Operation applied to hourly data to compute unique daily value.",
+    abstract="Operation applied to hourly data to compute unique daily value. "
+    "Give multiple operations to compute them all in a single pass over the data.",
     allowed_values=["mean", "sum", "min", "max"],
     data_type="string",
     min_occurs=1,
-    max_occurs=1,
+    max_occurs=4,
 )
 
 output_name = LiteralInput(
@@ -1,22 +1,39 @@
+import logging
+import os
 import shutil
 import zipfile
+from hashlib import sha256
 from pathlib import Path
 from unittest import mock
 
+import dask
+import geopandas as gpd
 import numpy as np
 import pandas as pd
 import pytest
+import shapely
 import xarray as xr
 from pywps import configuration
 
-from finch.processes import ensemble_utils
+import finch.processes.utils
+from finch.processes import ensemble_utils, polygons
 from finch.processes.utils import (
+    DatasetConfiguration,
+    chunk_dataset,
+    chunk_regions,
+    chunk_time_series,
+    dataset_to_netcdf,
     drs_filename,
+    get_datasets_config,
     is_opendap_url,
+    make_tasmin_tasmax_pairs,
     netcdf_file_list_to_csv,
+    opened_datasets,
+    try_opendap,
     valid_filename,
     zip_files,
 )
+from finch.processes.wps_base import make_nc_input
 
 test_data = Path(__file__).parent / "data"
 
@@ -123,6 +140,459 @@ def test_is_opendap_url():
     # assert not is_opendap_url(url)
 
 
+def test_get_datasets_config_reloads_on_change(tmp_path, monkeypatch):
+    config = tmp_path / "datasets.yml"
+    config.write_text(
+        (Path(__file__).parent / "test_data.yml").read_text().replace("../../", "")
+    )
+    monkeypatch.setattr(
+        finch.processes.utils, "get_config_value", lambda *args: str(config)
+    )
+
+    first = get_datasets_config()
+    assert first["test_subset"] is get_datasets_config()["test_subset"]
+    assert first["test_subset"].variables == {"tasmin", "tasmax"}
+    assert first["test_single_cell"].resolve_models(["PCIC12"])[1] == (
+        "CCSM4",
+        "r2i1p1",
+    )
+
+    config.write_text(config.read_text().replace("[ tasmin, tasmax ]", "[ tasmin ]"))
+    # Make sure the modification time changes, whatever the filesystem resolution.
+    stat = config.stat()
+    os.utime(config, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+    second = get_datasets_config()
+    assert second["test_subset"] is not first["test_subset"]
+    assert second["test_subset"].variables == {"tasmin"}
+
+
+def test_try_opendap_shared_datasets():
+    path = test_data / "bccaqv2_subset_sample/tasmax_bcc-csm1-1_rcp45_subset.nc"
+    inputs = [make_nc_input("tasmin"), make_nc_input("tasmax")]
+    for inp in inputs:
+        inp.workdir = str(test_data)
+        inp.file = str(path)
+
+    with mock.patch.object(xr.Dataset, "close") as close:
+        with opened_datasets() as datasets:
+            ds = try_opendap(inputs[0], cache=datasets)
+            assert try_opendap(inputs[1], cache=datasets) is ds
+            # Different options give a different dataset
+            assert try_opendap(inputs[1], decode_times=False, cache=datasets) is not ds
+            assert len(datasets) == 2
+            close.assert_not_called()
+        assert close.call_count == 2
+
+
+def test_is_opendap_url_cached(monkeypatch):
+    response = mock.Mock(headers={"Content-Description": "dods-dds"})
+    session = mock.Mock(head=mock.Mock(return_value=response))
+    monkeypatch.setattr(finch.processes.utils, "get_http_session", lambda: session)
+    monkeypatch.setattr(finch.processes.utils, "_opendap_probes", {})
+
+    assert is_opendap_url("https://example.com/dodsC/data/tasmin.nc")
+    # Same server directory, the probe is not repeated.
+    assert is_opendap_url("https://example.com/dodsC/data/tasmax.nc")
+    assert session.head.call_count == 1
+
+    response.headers = {}
+    assert not is_opendap_url("https://example.com/fileServer/data/tasmin.nc")
+    assert session.head.call_count == 2
+
+    assert not is_opendap_url("file:///data/tasmin.nc")
+    assert session.head.call_count == 2
+
+
+def test_is_opendap_url_configured_server(monkeypatch):
+    session = mock.Mock()
+    monkeypatch.setattr(finch.processes.utils, "get_http_session", lambda: session)
+    monkeypatch.setattr(
+        finch.processes.utils,
+        "get_datasets_config",
+        lambda: {
+            "remote": DatasetConfiguration(
+                path="https://example.com/thredds/catalog/data/catalog.xml",
+                pattern="{variable}_{model}_{scenario}.nc",
+                local=False,
+                allowed_values={},
+            )
+        },
+    )
+
+    assert is_opendap_url("https://example.com/thredds/dodsC/data/tasmin.nc")
+    session.head.assert_not_called()
+
+
+def test_prefetch_inputs(tmp_path, monkeypatch):
+    path = test_data / "bccaqv2_subset_sample/tasmax_bcc-csm1-1_rcp45_subset.nc"
+    content = path.read_bytes()
+
+    def fake_get(url, headers=None, **kwargs):
+        start = int(headers["Range"][6:-1]) if headers else 0
+        response = mock.MagicMock(status_code=206 if start else 200)
+        response.__enter__.return_value = response
+        response.iter_content.return_value = [content[start:]]
+        return response
+
+    session = mock.Mock(get=mock.Mock(side_effect=fake_get))
+    monkeypatch.setattr(finch.processes.utils, "get_http_session", lambda: session)
+    monkeypatch.setattr(finch.processes.utils, "is_opendap_url", lambda url: False)
+    monkeypatch.setattr(finch.processes.utils, "write_log", lambda *args: None)
+    config = {("finch", "cache_dir"): str(tmp_path / "cache")}
+    monkeypatch.setattr(
+        finch.processes.utils,
+        "get_config_value",
+        lambda *args: config.get(args, ""),
+    )
+
+    inputs = []
+    for i in range(3):
+        inp = make_nc_input("tasmax")
+        inp.workdir = str(tmp_path)
+        inp.url = f"https://example.com/data/tasmax_{i}.nc"
+        inputs.append(inp)
+    # The same url given twice is downloaded once
+    inp = make_nc_input("tasmax")
+    inp.workdir = str(tmp_path)
+    inp.url = inputs[1].url
+    inputs.append(inp)
+
+    # A previous partial download is resumed
+    first = (
+        tmp_path
+        / "cache"
+        / "downloads"
+        / sha256(inputs[0].url.encode()).hexdigest()[:16]
+        / "tasmax_0.nc"
+    )
+    first.parent.mkdir(parents=True)
+    first.with_name(f"tasmax_0.nc.{os.getpid()}.part").write_bytes(content[:100])
+
+    finch.processes.utils.prefetch_inputs(None, inputs)
+
+    assert session.get.call_count == 3
+    assert [Path(inp.file).name for inp in inputs] == [
+        f"tasmax_{i}.nc" for i in [0, 1, 2, 1]
+    ]
+    assert all(Path(inp.file).read_bytes() == content for inp in inputs)
+
+    # Cached files are not downloaded again.
+    inp = make_nc_input("tasmax")
+    inp.workdir = str(tmp_path)
+    inp.url = "https://example.com/data/tasmax_0.nc"
+    finch.processes.utils.prefetch_inputs(None, [inp])
+    assert session.get.call_count == 3
+    assert inp.file == str(first)
+
+    # The least recently used downloads are removed
+    monkeypatch.setattr(finch.processes.utils, "MAX_DOWNLOADS", 2)
+    inp = make_nc_input("tasmax")
+    inp.workdir = str(tmp_path)
+    inp.url = "https://example.com/data/tasmax_3.nc"
+    finch.processes.utils.prefetch_inputs(None, [inp])
+    cached = sorted(p.name for p in (tmp_path / "cache" / "downloads").glob("*/*"))
+    assert cached == ["tasmax_0.nc", "tasmax_3.nc"]
+
+
+def test_prune_cache(tmp_path):
+    for i in range(3):
+        f = tmp_path / f"{i}.npz"
+        f.write_bytes(b"")
+        os.utime(f, (i, i))
+    # A file removed by another process while pruning
+    (tmp_path / "gone.npz").symlink_to(tmp_path / "missing")
+
+    finch.processes.utils.prune_cache(tmp_path, "*.npz", 2)
+    assert sorted(f.name for f in tmp_path.glob("?.npz")) == ["1.npz", "2.npz"]
+
+
+def test_prefetch_inputs_same_name(tmp_path, monkeypatch):
+    def fake_get(url, **kwargs):
+        response = mock.MagicMock(status_code=200)
+        response.__enter__.return_value = response
+        response.iter_content.return_value = [url.encode()]
+        return response
+
+    session = mock.Mock(get=mock.Mock(side_effect=fake_get))
+    monkeypatch.setattr(finch.processes.utils, "get_http_session", lambda: session)
+    monkeypatch.setattr(finch.processes.utils, "is_opendap_url", lambda url: False)
+    monkeypatch.setattr(finch.processes.utils, "write_log", lambda *args: None)
+    # No cache_dir: files are downloaded in the working directory
+    monkeypatch.setattr(finch.processes.utils, "get_config_value", lambda *args: "")
+
+    urls = [f"https://example.com/{model}/tasmax.nc" for model in ["modelA", "modelB"]]
+    inputs = []
+    for url in urls:
+        inp = make_nc_input("tasmax")
+        inp.workdir = str(tmp_path)
+        inp.url = url
+        inputs.append(inp)
+
+    finch.processes.utils.prefetch_inputs(None, inputs)
+
+    assert inputs[0].file != inputs[1].file
+    for inp, url in zip(inputs, urls):
+        assert Path(inp.file).name == "tasmax.nc"
+        assert Path(inp.file).read_bytes() == url.encode()
+
+
+def test_chunk_dataset():
+    ds = xr.Dataset(
+        {"tas": (("time", "lat", "lon"), np.zeros((3650, 100, 120), dtype="float32"))}
+    )
+    ds.tas.encoding["chunksizes"] = (365, 10, 12)
+
+    # 2 MB budget, time kept whole for indicators
+    chunks = chunk_dataset(ds, max_bytes="2MB", operation="time")
+    assert chunks["time"] == 3650
+    assert chunks["lat"] * chunks["lon"] * 3650 * 4 <= 2e6
+    assert chunks["lat"] % 10 == 0 or chunks["lat"] < 10
+    assert chunks["lon"] % 12 == 0 or chunks["lon"] < 12
+
+    # Spatial dimensions kept whole for spatial averages, time aligned with the disk chunks.
+    chunks = chunk_dataset(ds, max_bytes="20MB", operation="space")
+    assert (chunks["lat"], chunks["lon"]) == (100, 120)
+    assert chunks["time"] % 365 == 0
+    assert chunks["time"] * 100 * 120 * 4 <= 20e6
+
+    # Legacy element count
+    chunks = chunk_dataset(ds, max_size=1000000, chunk_dims=["time"])
+    assert chunks["time"] * 100 * 120 < 1000000
+
+
+def test_chunk_regions():
+    ds = xr.Dataset(
+        {"tas": (("region", "time"), np.zeros((500, 365 * 30), dtype="float32"))}
+    )
+    # All sites fit in memory: a single block
+    assert chunk_regions(ds, max_bytes="100MB") == {"time": -1, "region": 500}
+    # Split between workers
+    assert chunk_regions(ds, max_bytes="100MB", workers=4, single_block=False) == {
+        "time": -1,
+        "region": 125,
+    }
+    # Limited by the memory budget
+    assert chunk_regions(ds, max_bytes="4MB", workers=4)["region"] == 91
+
+
+def test_chunk_time_series():
+    ds = xr.Dataset(
+        {"tas": (("time", "lat", "lon"), np.zeros((365 * 30, 40, 50), dtype="float32"))}
+    )
+    # Time kept whole, cells split between the workers
+    assert chunk_time_series(ds, max_bytes="1GB", workers=4) == {
+        "time": -1,
+        "lat": 20,
+        "lon": 25,
+    }
+    # The rolling window multiplies the memory needed per cell
+    chunks = chunk_time_series(ds, window=31, max_bytes="100MB", workers=1)
+    assert chunks["lat"] * chunks["lon"] * 365 * 30 * 31 * 4 <= 100e6
+    # Single time series
+    assert chunk_time_series(ds.tas.isel(lat=0, lon=0)) == {"time": -1}
+
+
+def _grid_dataset():
+    lat = np.arange(40.5, 50, 1.0)
+    lon = np.arange(-79.5, -70, 1.0)
+    data = np.arange(3 * lat.size * lon.size, dtype=float)
+    return xr.Dataset(
+        {"tas": (("time", "lat", "lon"), data.reshape(3, lat.size, lon.size))},
+        coords={
+            "time": pd.date_range("2000-01-01", periods=3),
+            "lat": ("lat", lat, {"standard_name": "latitude", "units": "degrees_N"}),
+            "lon": ("lon", lon, {"standard_name": "longitude", "units": "degrees_E"}),
+        },
+    )
+
+
+def test_spatial_average():
+    ds = _grid_dataset()
+    shape = gpd.GeoDataFrame(
+        {"name": ["a", "b"]},
+        geometry=[shapely.box(-79, 41, -77, 43), shapely.box(-75.5, 44.5, -74.5, 45.5)],
+        crs="EPSG:4326",
+    )
+
+    weights = polygons.compute_weights(ds, shape)
+    # 2 x 2 whole cells for the first box, 4 quarters of cells for the second
+    assert (weights[[0], :] > 0).sum() == 4
+    assert (weights[[1], :] > 0).sum() == 4
+
+    # Missing values are left out
+    ds["tas"][:, 0, 0] = np.nan
+    out = polygons.spatial_average(ds.chunk(time=1), shape, weights=weights)
+    assert out.tas.dims == ("time", "geom")
+    assert list(out.name.values) == ["a", "b"]
+
+    sub = ds.tas.sel(lat=[44.5, 45.5], lon=[-75.5, -74.5])
+    w = np.cos(np.deg2rad(sub.lat)) * xr.ones_like(sub.lon)
+    np.testing.assert_allclose(
+        out.tas.isel(geom=1), sub.weighted(w).mean(["lat", "lon"])
+    )
+    assert not out.tas.isel(geom=0).isnull().any()
+
+    # A single geometry is squeezed
+    out = polygons.spatial_average(ds, shape.iloc[[1]])
+    assert out.tas.dims == ("time",)
+
+
+def test_spatial_average_lon_0_360():
+    ds = _grid_dataset()
+    wrapped = ds.assign_coords(lon=ds.lon.copy(data=ds.lon.values + 360))
+    shape = gpd.GeoDataFrame(geometry=[shapely.box(-79, 41, -77, 43)], crs="EPSG:4326")
+
+    cropped = polygons.crop_to_shape(wrapped, shape)
+    assert cropped.lon.values.tolist() == [280.5, 281.5, 282.5, 283.5]
+
+    weights = polygons.compute_weights(wrapped, shape)
+    assert (weights != polygons.compute_weights(ds, shape)).nnz == 0
+    xr.testing.assert_allclose(
+        polygons.spatial_average(wrapped, shape).tas,
+        polygons.spatial_average(ds, shape).tas,
+    )
+
+
+def test_polygon_weights_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(polygons, "get_cache_dir", lambda kind: tmp_path)
+    monkeypatch.setattr(polygons, "_memory", type(polygons._memory)())
+    ds = _grid_dataset()
+    shape = gpd.GeoDataFrame(geometry=[shapely.box(-79, 41, -77, 43)], crs="EPSG:4326")
+
+    weights = polygons.polygon_weights(ds, shape)
+    assert len(list(tmp_path.glob("*.npz"))) == 1
+
+    # Reused from memory, then from disk
+    assert polygons.polygon_weights(ds, shape) is weights
+    polygons._memory.clear()
+    with mock.patch.object(polygons, "compute_weights") as compute:
+        cached = polygons.polygon_weights(ds.copy(), shape.copy())
+        compute.assert_not_called()
+    assert (cached != weights).nnz == 0
+
+
+def test_cached_key_locks(monkeypatch):
+    monkeypatch.setattr(polygons, "get_cache_dir", lambda kind: None)
+    monkeypatch.setattr(polygons, "_memory", type(polygons._memory)())
+    monkeypatch.setattr(polygons, "_key_locks", {})
+
+    def fail():
+        raise ValueError("no data")
+
+    # Locks of the keys are discarded on every exit path
+    with pytest.raises(ValueError):
+        polygons._cached("test", "key", fail, None, None, ".npz")
+    assert polygons._key_locks == {}
+
+    obj = polygons._cached("test", "key", object, None, None, ".npz")
+    assert polygons._cached("test", "key", fail, None, None, ".npz") is obj
+    assert polygons._key_locks == {}
+
+
+def test_prepare_shape_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(polygons, "get_cache_dir", lambda kind: tmp_path)
+    monkeypatch.setattr(polygons, "_memory", type(polygons._memory)())
+    path = tmp_path / "shape.geojson"
+    gpd.GeoDataFrame(
+        {"FID": [3, 7], "name": ["a", "b"]},
+        geometry=[shapely.box(-79, 41, -77, 43), shapely.box(-75.5, 44.5, -74.5, 45.5)],
+        crs="EPSG:4326",
+    ).to_file(path)
+
+    shape = polygons.prepare_shape(path)
+    assert len(list(tmp_path.glob("*.gpkg"))) == 1
+
+    # Read back from disk, without unpickling anything
+    polygons._memory.clear()
+    with mock.patch.object(polygons, "read_shape") as read:
+        cached = polygons.prepare_shape(path)
+        read.assert_not_called()
+    assert cached.crs == shape.crs
+    # All columns are kept, including a shapefile FID
+    assert list(cached.columns) == list(shape.columns) == ["FID", "name", "geometry"]
+    assert list(cached.FID) == [3, 7]
+    assert list(cached.name) == ["a", "b"]
+    assert cached.geom_equals(shape).all()
+
+
+def test_spatial_average_many_polygons(tmp_path):
+    ds = _grid_dataset().chunk(time=1)
+    # One polygon per cell
+    lon, lat = np.meshgrid(ds.lon.values, ds.lat.values)
+    shape = gpd.GeoDataFrame(
+        {"cell": np.arange(lat.size)},
+        geometry=shapely.box(lon - 0.5, lat - 0.5, lon + 0.5, lat + 0.5).ravel(),
+        crs="EPSG:4326",
+    )
+
+    out = polygons.spatial_average(ds, shape)
+    assert out.tas.chunks == ((1, 1, 1), (lat.size,))
+
+    path = tmp_path / "avg.nc"
+    # Small outputs are loaded at once
+    with mock.patch.object(xr.Dataset, "load", wraps=out.load) as load:
+        dataset_to_netcdf(out, path, stream=True)
+        load.assert_called_once()
+
+    # Larger ones are streamed
+    path.unlink()
+    with (
+        mock.patch.object(finch.processes.utils, "MEMORY_LIMIT", 0),
+        mock.patch.object(xr.Dataset, "load") as load,
+    ):
+        dataset_to_netcdf(out, path, stream=True)
+        load.assert_not_called()
+    # The synchronous scheduler is only used for the write
+    assert dask.config.get("scheduler", None) is None
+
+    with xr.open_dataset(path) as written:
+        np.testing.assert_allclose(
+            written.tas.values, ds.tas.values.reshape(3, -1), rtol=1e-12
+        )
+
+
+class CountingArray(xr.backends.BackendArray):
+    """Stand-in for a remote (OPeNDAP) array, counting the bytes read."""
+
+    def __init__(self, array):
+        self.array = array
+        self.shape = array.shape
+        self.dtype = array.dtype
+        self.bytes_read = 0
+
+    def __getitem__(self, key):
+        """Read the indexed values, with basic (orthogonal slices) indexing only."""
+        return xr.core.indexing.explicit_indexing_adapter(
+            key, self.shape, xr.core.indexing.IndexingSupport.BASIC, self._getitem
+        )
+
+    def _getitem(self, key):
+        out = self.array[key]
+        self.bytes_read += out.nbytes
+        return out
+
+
+def test_crop_to_shape_bytes_read():
+    ds = _grid_dataset()
+    remote = CountingArray(ds.tas.values)
+    ds["tas"] = xr.Variable(ds.tas.dims, xr.core.indexing.LazilyIndexedArray(remote))
+    shape = gpd.GeoDataFrame(
+        geometry=[shapely.box(-75.5, 44.5, -74.5, 45.5)], crs="EPSG:4326"
+    )
+
+    cropped = polygons.crop_to_shape(ds, shape)
+    # The box and one cell around it
+    assert list(cropped.lat.values) == [43.5, 44.5, 45.5, 46.5]
+    assert list(cropped.lon.values) == [-76.5, -75.5, -74.5, -73.5]
+
+    out = polygons.spatial_average(cropped, shape).load()
+    assert remote.bytes_read == 3 * 4 * 4 * 8
+
+    expected = polygons.spatial_average(_grid_dataset(), shape)
+    xr.testing.assert_allclose(out.tas, expected.tas)
+
+
 def test_make_file_groups():
     folder = Path(__file__).parent / "data" / "bccaqv2_single_cell"
     files_list = list(folder.glob("*.nc"))
@@ -132,6 +602,60 @@ def test_make_file_groups():
     assert all(len(g) == 3 for g in groups)
 
 
+def test_make_file_groups_unmatched(caplog):
+    files_list = [
+        Path(f)
+        for f in [
+            "tasmin_model1_rcp45.nc",
+            "tasmax_model1_rcp45.nc",
+            "tasmin_per_model1_rcp45.nc",
+            "tasmin_model2_rcp45.nc",
+            "readme.nc",
+        ]
+    ]
+    with caplog.at_level(logging.WARNING, logger="PYWPS"):
+        groups = ensemble_utils.make_file_groups(
+            files_list, {"tasmin", "tasmax", "tasmin_per"}
+        )
+
+    assert groups == [
+        {
+            "tasmin": Path("tasmin_model1_rcp45.nc"),
+            "tasmax": Path("tasmax_model1_rcp45.nc"),
+            "tasmin_per": Path("tasmin_per_model1_rcp45.nc"),
+        },
+        {"tasmin": Path("tasmin_model2_rcp45.nc")},
+    ]
+    assert "readme.nc" in caplog.text
+    assert "tasmin_model2_rcp45.nc" in caplog.text
+
+
+def test_make_tasmin_tasmax_pairs():
+    filenames = [
+        Path(f)
+        for f in [
+            "tasmax_model1.nc",
+            "tasmin_model2.nc",
+            "tasmin_model1.nc",
+            "tasmax_model3.nc",
+            "TASMAX_model2.nc",
+            "tasmin_model4.nc",
+        ]
+    ]
+    with mock.patch("finch.processes.utils.sentry_sdk") as sentry:
+        pairs = list(make_tasmin_tasmax_pairs(filenames))
+
+    assert pairs == [
+        (Path("tasmin_model2.nc"), Path("TASMAX_model2.nc")),
+        (Path("tasmin_model1.nc"), Path("tasmax_model1.nc")),
+    ]
+    # Unmatched files are reported, whether tasmin or tasmax
+    messages = [c.args[0] for c in sentry.capture_message.call_args_list]
+    assert len(messages) == 2
+    assert "tasmin_model4.nc" in messages[0]
+    assert "tasmax_model3.nc" in messages[1]
+
+
 def test_drs_filename():
     ds = xr.open_dataset(
         test_data / "bccaqv2_subset_sample/tasmax_bcc-csm1-1_rcp45_subset.nc"
@@ -51,7 +51,7 @@ def test_wps_caps_no_datasets(client, monkeypatch):
     for mod in mod_dict.keys():
         indicators.extend(mod_dict[mod]["indicators"])
     subset_processes_count = 4
-    sdba_processes_count = 1
+    sdba_processes_count = 3
     others = 1
     assert len(
         indicators
@@ -1,15 +1,22 @@
 import zipfile
 from collections import namedtuple
 from pathlib import Path
+from unittest import mock
 
 import geojson
 import numpy as np
+import pandas as pd
 import pytest
+import xarray as xr
+from pywps import LiteralInput
 from pywps.app.exceptions import ProcessError
 from xarray import open_dataset
+from xclim import ensembles
+from xclim.indicators.atmos import tx_days_above
 
 from _utils import execute_process, wps_literal_input
 from finch.processes import ensemble_utils
+from finch.processes.utils import compute_indices
 
 mock_filenames = [
     "tasmax_bcc-csm1-1_rcp45_subset.nc",
@@ -727,6 +734,35 @@ def test_ensemble_heatwave_frequency_grid_point_models_pcic(client):
     execute_process(client, identifier, inputs)
 
 
+def test_make_ensemble_streams_members(tmp_path):
+    rng = np.random.default_rng(0)
+    files = []
+    for i in range(5):
+        ds = xr.Dataset(
+            {"tx_mean": (("time", "lat", "lon"), rng.random((10, 40, 50)))},
+            coords={
+                "time": pd.date_range("2000-01-01", periods=10, freq="YS"),
+                "lat": np.arange(40),
+                "lon": np.arange(50),
+            },
+        )
+        files.append(tmp_path / f"tx_mean_{i}.nc")
+        ds.to_netcdf(files[-1])
+
+    ens = ensemble_utils.open_ensemble(files, max_bytes="200kB")
+    # One block of all members fits the budget
+    _, time, lat, lon = ens.tx_mean.data.chunksize
+    assert time == 10
+    assert 5 * time * lat * lon * 8 <= 200_000
+
+    out = ensemble_utils.make_ensemble(files, percentiles=[10, 50, 90])
+    expected = ensembles.ensemble_percentiles(
+        ensembles.create_ensemble(files, realizations=[f.stem for f in files]).load(),
+        values=[10, 50, 90],
+    )
+    xr.testing.assert_allclose(out.load(), expected)
+
+
 def test_compute_intermediate_variables(monkeypatch):
     # --- given ---
     workdir = Path(__file__).parent / "tmp" / "temp_compute_intermediate_variables"
@@ -757,6 +793,122 @@ def test_compute_intermediate_variables(monkeypatch):
     assert sorted(files_outputs) == sorted(expected)
 
 
+def test_compute_intermediate_variables_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(ensemble_utils, "get_cache_dir", lambda kind: tmp_path / kind)
+    (tmp_path / "intermediate").mkdir()
+    written = []
+    to_netcdf = ensemble_utils.dataset_to_netcdf
+
+    def spy(ds, path):
+        written.append(path.name)
+        to_netcdf(ds, path)
+
+    monkeypatch.setattr(ensemble_utils, "dataset_to_netcdf", spy)
+
+    subset_folder = Path(__file__).parent / "data" / "bccaqv2_subset_sample"
+    mock_paths = [subset_folder / p for p in mock_filenames]
+    literal_input = namedtuple("LiteralInput", ["data", "identifier"])
+    request_inputs = {"perc_tas": [literal_input(10, "perc_tas")]}
+
+    outputs = {}
+    for request in ["first", "second"]:
+        workdir = tmp_path / request
+        workdir.mkdir()
+        outputs[request] = ensemble_utils.compute_intermediate_variables(
+            mock_paths, {"tasmin", "tasmax"}, ["tas_per"], workdir, request_inputs
+        )
+
+    # tas and tas_per were only computed by the first request
+    assert len(written) == 4
+    assert len(list((tmp_path / "intermediate").glob("*.nc"))) == 4
+    for first, second in zip(sorted(outputs["first"]), sorted(outputs["second"])):
+        assert first.name == second.name
+        assert second.parent == tmp_path / "second"
+        xr.testing.assert_identical(xr.open_dataset(first), xr.open_dataset(second))
+
+    # The least recently used variables are removed
+    monkeypatch.setattr(ensemble_utils, "MAX_CACHED_VARIABLES", 2)
+    request_inputs = {"perc_tas": [literal_input(20, "perc_tas")]}
+    workdir = tmp_path / "third"
+    workdir.mkdir()
+    ensemble_utils.compute_intermediate_variables(
+        mock_paths, {"tasmin", "tasmax"}, ["tas_per"], workdir, request_inputs
+    )
+    assert len(written) == 6
+    assert len(list((tmp_path / "intermediate").glob("*.nc"))) == 2
+
+
+def test_make_indicator_inputs(monkeypatch):
+    subset_folder = Path(__file__).parent / "data" / "bccaqv2_subset_sample"
+    files = [subset_folder / p for p in mock_filenames if p.startswith("tasmax")]
+    wps_inputs = {"thresh": [LiteralInput("thresh", "thresh", data_type="string")]}
+    wps_inputs["thresh"][0].data = "30 degC"
+
+    arguments = ensemble_utils.make_indicator_inputs(tx_days_above, wps_inputs, files)
+
+    assert [a.sources["tasmax"] for a in arguments] == files
+    # Resolved arguments are shared, not copied for each member
+    assert arguments[0].kwargs is arguments[1].kwargs
+    assert dict(arguments[0].kwargs) == {"thresh": "30 degC"}
+    with pytest.raises(TypeError):
+        arguments[0].kwargs["thresh"] = "25 degC"
+
+    monkeypatch.setattr("finch.processes.utils.write_log", mock.Mock())
+    out = compute_indices(mock.Mock(), tx_days_above, arguments[0])
+    expected = tx_days_above(tasmax=open_dataset(files[0]).tasmax, thresh="30 degC")
+    np.testing.assert_array_equal(out.tx_days_above, expected)
+
+
+def test_plan_computations():
+    plan = ensemble_utils.plan_computations(
+        {"tas", "tas_per", "tasmax_per", "prsn"}, {"tasmin", "tasmax", "pr"}
+    )
+    assert plan.raw == {"tasmin", "tasmax"}
+    assert plan.extra == {"prsn"}
+    assert set(plan.steps) == {"tas", "tas_per", "tasmax_per"}
+    # Intermediates are computed once, before the variables that use them
+    assert plan.steps.index("tas") < plan.steps.index("tas_per")
+    assert "tas_per <- tas" in str(plan)
+
+    # Available variables are never recomputed
+    plan = ensemble_utils.plan_computations({"tas_per"}, {"tas", "tasmax"})
+    assert plan.raw == {"tas"}
+    assert plan.steps == ("tas_per",)
+
+
+def test_batched_percentile_doy():
+    time = xr.cftime_range("2000-01-01", periods=365 * 4, freq="D", calendar="noleap")
+    rng = np.random.default_rng(0)
+    variables = [
+        xr.DataArray(
+            rng.random((time.size, 3)),
+            dims=("time", "site"),
+            coords={"time": time, "site": np.arange(3) + 10 * i, "lat": 45.0 + i},
+            name="tasmax",
+            attrs={"units": "K"},
+        )
+        for i in range(4)
+    ]
+    # A member with a different period can't be stacked with the others
+    variables.append(variables[0].isel(time=slice(0, 365 * 3)))
+
+    expected = [ensemble_utils._percentile_doy(var, 90) for var in variables]
+    # The history holds a timestamp
+    for exp in expected:
+        del exp.attrs["history"]
+    # The windows of two members fit in the budget, of one member, or of none
+    member_bytes = 5 * variables[0].nbytes
+    for max_bytes, n_calls in [(None, 2), (2 * member_bytes, 3), (1, 5)]:
+        with mock.patch.object(
+            ensemble_utils, "_percentile_doy", wraps=ensemble_utils._percentile_doy
+        ) as spy:
+            batched = ensemble_utils.batched_percentile_doy(variables, 90, max_bytes)
+        assert spy.call_count == n_calls
+        for out, exp in zip(batched, expected):
+            del out.attrs["history"]
+            xr.testing.assert_identical(out, exp)
+
+
 def test_ensemble_compute_intermediate_cold_spell_duration_index_grid_point(client):
     # --- given ---
     identifier = "ensemble_grid_point_cold_spell_duration_index"
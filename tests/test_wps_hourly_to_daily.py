@@ -1,9 +1,13 @@
 from pathlib import Path
 
 import numpy as np
+import pandas as pd
+import pytest
 import xarray as xr
+from xclim.core.options import MISSING_METHODS
 
 from _utils import execute_process, wps_input_file, wps_literal_input
+from finch.processes.wps_hourly_to_daily import _daily_blocks, _hourly_to_daily
 
 
 def test_wps_hourly_to_daily(client, hourly_dataset):
@@ -20,3 +24,59 @@ def test_wps_hourly_to_daily(client, hourly_dataset):
         assert ds.pr.attrs["cell_methods"].endswith(" time: sum within days")
         assert ds.pr.isel(time=0).isnull()
         assert ds.pr.isel(time=1) == np.sum(np.arange(24, 48))
+
+
+def test_wps_hourly_to_daily_multiple_reducers(client, hourly_dataset):
+    identifier = "hourly_to_daily"
+    inputs = [
+        wps_input_file("resource", hourly_dataset),
+        wps_literal_input("reducer", "min"),
+        wps_literal_input("reducer", "max"),
+        wps_literal_input("reducer", "mean"),
+    ]
+    outputs = execute_process(client, identifier, inputs)
+    with xr.open_dataset(outputs[0]) as ds:
+        assert set(ds.data_vars) == {"pr_min", "pr_max", "pr_mean"}
+        assert ds.pr_max.attrs["cell_methods"].endswith(" time: max within days")
+        assert ds.pr_min.isel(time=0).isnull()
+        assert ds.pr_min.isel(time=1) == 24
+        assert ds.pr_max.isel(time=1) == 47
+        assert ds.pr_mean.isel(time=1) == np.mean(np.arange(24, 48))
+
+
+@pytest.mark.parametrize("reducer", ["mean", "sum", "min", "max"])
+@pytest.mark.parametrize(
+    "check_missing,options",
+    [("skip", {}), ("any", {}), ("pct", {"tolerance": 0.1}), ("at_least_n", {"n": 20})],
+)
+def test_hourly_to_daily_blocks(reducer, check_missing, options):
+    # Partial first and last days, and a few missing hours
+    time = pd.date_range("2000-01-01 05:00", periods=24 * 5, freq="h")
+    data = np.random.rand(time.size, 3)
+    data[[10, 30, 31, 32, 40], 1] = np.nan
+    data[50:56, 2] = np.nan
+    ds = xr.Dataset(
+        {"pr": (("time", "site"), data, {"units": "mm/h"})}, coords={"time": time}
+    ).chunk({"time": 50})
+
+    out = _hourly_to_daily(ds, reducer, check_missing, options)
+
+    expected = getattr(ds.resample(time="D"), reducer)()
+    if check_missing != "skip":
+        mask = MISSING_METHODS[check_missing].execute(
+            ds.pr, freq="D", src_timestep="H", options=options, indexer={}
+        )
+        expected = expected.where(~mask)
+    xr.testing.assert_allclose(out.pr, expected.pr)
+    assert out.pr.attrs["cell_methods"] == f"time: {reducer} within days"
+
+
+def test_hourly_to_daily_irregular():
+    time = pd.date_range("2000-01-01", periods=24 * 3, freq="h").delete([5, 6])
+    ds = xr.Dataset(
+        {"pr": (("time",), np.random.rand(time.size))}, coords={"time": time}
+    )
+    assert _daily_blocks(ds) is None
+
+    out = _hourly_to_daily(ds, "max", "any", {})
+    assert out.pr.isnull().values.tolist() == [True, False, False]
@@ -1,15 +1,31 @@
+from pathlib import Path
+from unittest import mock
 from urllib.parse import quote_plus
 
+import dask.distributed
 import numpy as np
 import pytest
 import xarray as xr
+from dask.delayed import Delayed
 from pywps import Service
 from pywps.tests import assert_response_success, client_for
 from xclim.core.calendar import convert_calendar
+from xclim.sdba import (
+    DetrendedQuantileMapping,
+    EmpiricalQuantileMapping,
+    Grouper,
+    QuantileDeltaMapping,
+)
 from xclim.sdba.utils import ADDITIVE, MULTIPLICATIVE
 
 from _common import CFG_FILE, get_output
-from finch.processes import EmpiricalQuantileMappingProcess
+from finch.processes import (
+    DetrendedQuantileMappingProcess,
+    EmpiricalQuantileMappingProcess,
+    QuantileDeltaMappingProcess,
+    utils,
+    wps_sdba,
+)
 
 
 @pytest.mark.parametrize("kind,name", [(ADDITIVE, "tas"), (MULTIPLICATIVE, "pr")])
@@ -44,3 +60,183 @@ def test_wps_empirical_quantile_mapping(netcdf_sdba_ds, kind, name):
     ref = xr.open_dataset(sdba_ds[f"qdm_{name}_ref"])[name]
     refc = convert_calendar(ref, "noleap")
     np.testing.assert_allclose(p[middle], refc[middle], rtol=0.03)
+
+
+def _gridded_files(folder):
+    rng = np.random.default_rng(0)
+    shape = (365 * 4, 2, 3)
+    files = {}
+    for key, loc in [("ref", 12), ("hist", 10), ("sim", 11)]:
+        da = xr.DataArray(
+            rng.normal(loc, 1, shape),
+            dims=("time", "lat", "lon"),
+            coords={"time": xr.date_range("2000-01-01", periods=shape[0], freq="D")},
+            name="tas",
+            attrs={"units": "K", "standard_name": "air_temperature"},
+        )
+        files[key] = folder / f"{key}.nc"
+        da.to_netcdf(files[key])
+    return files
+
+
+def _execute(datainputs, process=EmpiricalQuantileMappingProcess):
+    process = process()
+    client = client_for(Service(processes=[process], cfgfiles=CFG_FILE))
+    resp = client.get(
+        f"?service=WPS&request=Execute&version=1.0.0&identifier={process.identifier}&datainputs={datainputs}"
+    )
+    assert_response_success(resp)
+    return Path(get_output(resp.xml)["output"][7:])
+
+
+def test_wps_empirical_quantile_mapping_gridded(tmp_path, monkeypatch):
+    files = _gridded_files(tmp_path)
+    datainputs = (
+        f"ref=files@xlink:href=file://{files['ref']};"
+        f"hist=files@xlink:href=file://{files['hist']};"
+        f"sim=files@xlink:href=file://{files['sim']};"
+        "group=time.month;"
+        "window=5;"
+    )
+
+    expected = xr.open_dataset(_execute(datainputs)).load()
+
+    # Outputs too large for memory are streamed to disk
+    with monkeypatch.context() as m:
+        m.setattr(utils, "MEMORY_LIMIT", 0)
+        out = xr.open_dataset(_execute(datainputs)).load()
+    xr.testing.assert_allclose(out, expected)
+
+    # Same results on a local cluster (of threads, to keep the test short)
+    cluster = dask.distributed.LocalCluster(
+        n_workers=2, processes=False, dashboard_address=None
+    )
+    with dask.distributed.Client(cluster, set_as_default=False) as dask_client:
+        monkeypatch.setattr(wps_sdba, "get_sdba_client", lambda: dask_client)
+        out = xr.open_dataset(_execute(datainputs)).load()
+        xr.testing.assert_allclose(out, expected)
+
+        # Streamed by the workers of the cluster
+        with monkeypatch.context() as m:
+            m.setattr(utils, "MEMORY_LIMIT", 0)
+            compute = mock.Mock(wraps=dask_client.compute)
+            m.setattr(dask_client, "compute", compute)
+            out = xr.open_dataset(_execute(datainputs)).load()
+        # The delayed write is computed, not the dataset
+        assert isinstance(compute.call_args.args[0], Delayed)
+        xr.testing.assert_allclose(out, expected)
+    cluster.close()
+    assert out.tas.dims == ("time", "lat", "lon")
+
+
+def test_wps_empirical_quantile_mapping_train_then_adjust(tmp_path, monkeypatch):
+    files = _gridded_files(tmp_path)
+    train_inputs = (
+        f"ref=files@xlink:href=file://{files['ref']};"
+        f"hist=files@xlink:href=file://{files['hist']};"
+        "group=time.month;"
+    )
+    sim_input = f"sim=files@xlink:href=file://{files['sim']};"
+    expected = xr.open_dataset(_execute(train_inputs + sim_input)).load()
+
+    # Trained adjustments are cached and reused
+    (tmp_path / "sdba").mkdir()
+    monkeypatch.setattr(wps_sdba, "get_cache_dir", lambda kind: tmp_path / kind)
+    train = mock.Mock(wraps=EmpiricalQuantileMapping.train)
+    monkeypatch.setattr(EmpiricalQuantileMapping, "train", train)
+
+    trained = _execute("mode=train;" + train_inputs)
+    assert "af" in xr.open_dataset(trained)
+    out = xr.open_dataset(
+        _execute(f"mode=adjust;trained=files@xlink:href=file://{trained};{sim_input}")
+    ).load()
+    xr.testing.assert_allclose(out, expected)
+
+    out = xr.open_dataset(_execute(train_inputs + sim_input)).load()
+    xr.testing.assert_allclose(out, expected)
+    assert train.call_count == 1
+
+    # The least recently used adjustments are removed
+    monkeypatch.setattr(wps_sdba, "MAX_TRAINED", 1)
+    _execute("mode=train;" + train_inputs.replace("time.month", "time.season"))
+    assert train.call_count == 2
+    assert len(list((tmp_path / "sdba").glob("*.nc"))) == 1
+
+    # Other files are rejected
+    client = client_for(
+        Service(processes=[EmpiricalQuantileMappingProcess()], cfgfiles=CFG_FILE)
+    )
+    resp = client.get(
+        "?service=WPS&request=Execute&version=1.0.0&identifier=empirical_quantile_mapping"
+        f"&datainputs=mode=adjust;trained=files@xlink:href=file://{files['ref']};"
+        + sim_input
+    )
+    assert "input is not a trained adjustment" in resp.response[0].decode()
+
+
+@pytest.mark.parametrize(
+    "process,method",
+    [
+        (DetrendedQuantileMappingProcess, DetrendedQuantileMapping),
+        (QuantileDeltaMappingProcess, QuantileDeltaMapping),
+    ],
+)
+def test_wps_quantile_mapping_methods(tmp_path, process, method):
+    files = _gridded_files(tmp_path)
+    out = xr.open_dataset(
+        _execute(
+            f"ref=files@xlink:href=file://{files['ref']};"
+            f"hist=files@xlink:href=file://{files['hist']};"
+            f"sim=files@xlink:href=file://{files['sim']};"
+            "group=time.month;",
+            process,
+        )
+    ).load()
+
+    res = {
+        key: convert_calendar(xr.open_dataset(f).tas, "noleap")
+        for key, f in files.items()
+    }
+    bc = method.train(res["ref"], res["hist"], group=Grouper("time.month"))
+    expected = bc.adjust(res["sim"]).transpose(*res["sim"].dims)
+    np.testing.assert_allclose(out.tas, expected)
+
+
+def test_wps_empirical_quantile_mapping_missing_inputs(tmp_path):
+    files = _gridded_files(tmp_path)
+    client = client_for(
+        Service(processes=[EmpiricalQuantileMappingProcess()], cfgfiles=CFG_FILE)
+    )
+    resp = client.get(
+        "?service=WPS&request=Execute&version=1.0.0&identifier=empirical_quantile_mapping"
+        f"&datainputs=mode=adjust;sim=files@xlink:href=file://{files['sim']}"
+    )
+    assert "trained are required in adjust mode" in resp.response[0].decode()
+
+
+def test_align_noleap():
+    time = xr.date_range("1981-01-01", "2010-12-31", freq="D")
+    da = xr.DataArray(
+        np.random.rand(time.size, 4, 4),
+        dims=("time", "lat", "lon"),
+        coords={"time": time},
+        name="tas",
+    ).chunk({"time": -1, "lat": 2, "lon": 2})
+
+    out = wps_sdba.align_noleap(da)
+    # Lazy, and chunked like the source along the other dimensions
+    assert out.chunks[1:] == da.chunks[1:]
+    xr.testing.assert_identical(out, convert_calendar(da, "noleap"))
+
+    # Nothing to do on a noleap series
+    assert wps_sdba.align_noleap(out) is out
+
+    # 360-day series are realigned on the days of the year
+    time = xr.date_range(
+        "1981-01-01", periods=360 * 2, freq="D", calendar="360_day", use_cftime=True
+    )
+    da = xr.DataArray(np.arange(time.size), dims="time", coords={"time": time})
+    out = wps_sdba.align_noleap(da)
+    assert out.time.dt.calendar == "noleap"
+    np.testing.assert_array_equal(out, da)
+    assert out.time[-1].dt.strftime("%Y-%m-%d") == "1982-12-31"
@@ -1,8 +1,11 @@
+from unittest import mock
+
 import geojson
 import pytest
 import xarray as xr
 
 from _utils import execute_process, shapefile_zip, wps_input_file, wps_literal_input
+from finch.processes import polygons
 
 
 def test_wps_averagepoly(client, netcdf_datasets):
@@ -53,3 +56,33 @@ def test_wps_averagepoly_shapefile(client, netcdf_datasets, tolerance):
 
     assert ds.geom.size == 1
     assert ds.FID.values == [0]
+
+
+def test_wps_averagepoly_weights_reused(client, netcdf_datasets, monkeypatch):
+    # --- given ---
+    identifier = "average_polygon"
+    poly = {
+        "type": "Feature",
+        "id": "apolygon",
+        "geometry": {
+            "type": "Polygon",
+            "coordinates": [[[0.5, 0], [2.5, 0], [2.5, 2.5], [0.5, 2.5], [0.5, 0]]],
+        },
+    }
+    inputs = [
+        wps_input_file("resource", f"file://{netcdf_datasets['tasmin']}"),
+        wps_input_file("resource", f"file://{netcdf_datasets['tasmax']}"),
+        wps_literal_input("shape", geojson.dumps(poly)),
+    ]
+    monkeypatch.setattr(polygons, "_memory", type(polygons._memory)())
+    compute = mock.Mock(wraps=polygons.compute_weights)
+    monkeypatch.setattr(polygons, "compute_weights", compute)
+
+    # --- when ---
+    outputs = execute_process(client, identifier, inputs)
+
+    # --- then ---
+    # Both files share the same grid
+    assert compute.call_count == 1
+    ds = xr.open_dataset(outputs[0])
+    assert ds.geom.size == 1
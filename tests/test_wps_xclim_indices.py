@@ -3,6 +3,7 @@ from pathlib import Path
 from unittest import mock
 from zipfile import ZipFile
 
+import dask
 import numpy as np
 import pandas as pd
 import pytest
@@ -124,17 +125,21 @@ def test_wps_daily_temperature_range_multiple(client, netcdf_datasets):
         inputs.append(wps_input_file("tasmax", netcdf_datasets["tasmax"]))
         inputs.append(wps_input_file("tasmin", netcdf_datasets["tasmin"]))
 
-    with mock.patch(
-        "finch.processes.wps_xclim_indices.FinchProgressBar"
-    ) as mock_progress:
+    with (
+        mock.patch(
+            "finch.processes.wps_xclim_indices.FinchProgressBar"
+        ) as mock_progress,
+        mock.patch("dask.compute", wraps=dask.compute) as compute,
+    ):
         outputs = execute_process(
             client, identifier, inputs, output_names=["output", "ref"]
         )
 
+    # All files are computed at once, with a single progress bar.
+    assert compute.call_count == 1
+    assert mock_progress.call_count == 1
     assert mock_progress.call_args_list[0][1]["start_percentage"] == 0
-    assert mock_progress.call_args_list[0][1]["end_percentage"] == 20
-    assert mock_progress.call_args_list[4][1]["start_percentage"] == 80
-    assert mock_progress.call_args_list[4][1]["end_percentage"] == 100
+    assert mock_progress.call_args_list[0][1]["end_percentage"] == 100
 
     # FIXME: This is generally unsafe as an approach as the data is untrusted.
     et = etree.fromstring(outputs[1].data[0].encode())  # noqa: S320
@@ -144,6 +149,14 @@ def test_wps_daily_temperature_range_multiple(client, netcdf_datasets):
     assert len(set(urls)) == 5, "With different links"
     assert urls[1].endswith("-1.nc")
 
+    # Unless their results don't fit in memory together
+    with (
+        mock.patch("finch.processes.wps_xclim_indices.MEMORY_LIMIT", 0),
+        mock.patch("dask.compute", wraps=dask.compute) as compute,
+    ):
+        execute_process(client, identifier, inputs, output_names=["output", "ref"])
+    assert compute.call_count == 5
+
 
 def test_wps_daily_temperature_range_multiple_not_same_length(client, netcdf_datasets):
     identifier = "dtr"
@@ -1,7 +1,13 @@
+from unittest import mock
+
 import geojson
+import geopandas as gpd
 import xarray as xr
+from clisops.core.subset import subset_shape as clisops_subset_shape
 
 from _utils import execute_process, shapefile_zip, wps_input_file, wps_literal_input
+from finch.processes import polygons
+from finch.processes.subset import subset_shape
 
 poly = {
     "type": "Feature",
@@ -49,3 +55,52 @@ def test_wps_subsetpoly_shapefile(client, netcdf_datasets):
     ds = xr.open_dataset(outputs[0])
     assert list(ds.lat.values) == [0, 1, 2]
     assert list(ds.lon.values) == [1, 2]
+
+
+def test_wps_subsetpoly_mask_reused(client, netcdf_datasets, monkeypatch):
+    # --- given ---
+    identifier = "subset_polygon"
+    inputs = [
+        wps_input_file("resource", f"file://{netcdf_datasets['tasmin']}"),
+        wps_input_file("resource", f"file://{netcdf_datasets['tasmax']}"),
+        wps_literal_input("shape", geojson.dumps(poly)),
+    ]
+    monkeypatch.setattr(polygons, "_memory", type(polygons._memory)())
+    compute = mock.Mock(wraps=polygons.compute_mask)
+    monkeypatch.setattr(polygons, "compute_mask", compute)
+
+    # --- when ---
+    execute_process(client, identifier, inputs)
+
+    # --- then ---
+    # Both files share the same grid
+    assert compute.call_count == 1
+
+
+def test_subset_shape_same_as_clisops(netcdf_datasets):
+    ds = xr.open_dataset(netcdf_datasets["tasmin"])
+    shape = gpd.GeoDataFrame.from_features([poly], crs="EPSG:4326")
+
+    expected = clisops_subset_shape(ds, shape, start_date="2000")
+    out = subset_shape(ds, shape, start_date="2000")
+    xr.testing.assert_identical(out, expected)
+
+
+def test_wps_subsetpoly_shape_reused(client, netcdf_datasets, monkeypatch):
+    # --- given ---
+    identifier = "subset_polygon"
+    inputs = [
+        wps_input_file("resource", f"file://{netcdf_datasets['tasmin']}"),
+        wps_literal_input("shape", geojson.dumps(poly)),
+    ]
+    monkeypatch.setattr(polygons, "_memory", type(polygons._memory)())
+    read = mock.Mock(wraps=polygons.read_shape)
+    monkeypatch.setattr(polygons, "read_shape", read)
+
+    # --- when ---
+    execute_process(client, identifier, inputs)
+    execute_process(client, identifier, inputs)
+
+    # --- then ---
+    # The same geometries uploaded twice are read and validated once
+    assert read.call_count == 1